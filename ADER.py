@@ -15,83 +15,46 @@ class Ader():
     def __init__(self, item_num, args, reuse=None):
         self.args = args
         self.is_training = tf.placeholder(tf.bool, shape=())
-        self.input_seq = tf.placeholder(tf.int32, shape=(None, args.maxlen))
+        # input length can be shorter than maxlen when batches are trimmed to their longest sequence
+        self.input_seq = tf.placeholder(tf.int32, shape=(None, None))
         self.pos = tf.placeholder(tf.int32, shape=None)
-        self.exemplar_logits = tf.placeholder(tf.float32, shape=(None, None))
-        self.exemplar_pos = tf.placeholder(tf.int32, shape=None)
+        # per-example loss weight, e.g. the count of a collapsed duplicate example, defaults to 1
+        self.weight = tf.placeholder_with_default(tf.ones_like(self.pos, dtype=tf.float32), shape=(None,))
+        self.max_item_pre = tf.placeholder_with_default(0, shape=())
         self.max_item = tf.placeholder(tf.int32, shape=())
         self.lr = tf.placeholder(tf.float32, shape=())
+        # weight of exemplar loss, 0 for training without exemplars
+        self.lambda_ = tf.placeholder_with_default(0.0, shape=())
         self.dropout_rate = tf.placeholder(tf.float32, shape=())
         pos = self.pos
-        mask = tf.expand_dims(tf.to_float(tf.not_equal(self.input_seq, 0)), -1)
+
+        if args.exemplar_device:
+            # exemplars are kept in the graph, input sequences are followed by the exemplars selected by their index
+            self.build_exemplar_tables()
+        else:
+            self.exemplar_logits = tf.placeholder_with_default(tf.zeros([0, 0]), shape=(None, None))
+            self.exemplar_pos = tf.placeholder_with_default(tf.zeros([0], tf.int32), shape=None)
+            # top-K distillation targets: item indices of exemplar logits, probability mass of the other items
+            self.exemplar_index = tf.placeholder_with_default(tf.zeros([0, 0], tf.int32), shape=(None, None))
+            self.exemplar_tail = tf.placeholder_with_default(tf.zeros([0]), shape=None)
+            self.batch_seq = self.input_seq
 
         with tf.variable_scope("SASRec", reuse=reuse):
-            # sequence embedding, item embedding table
-            self.seq, item_emb_table = embedding(self.input_seq,
-                                                 vocab_size=item_num + 1,
-                                                 num_units=args.hidden_units,
-                                                 zero_pad=True,
-                                                 scale=True,
-                                                 l2_reg=args.l2_emb,
-                                                 scope="input_embeddings",
-                                                 with_t=True,
-                                                 reuse=reuse
-                                                 )
-
-            # # Positional Encoding
-            t, pos_emb_table = embedding(
-                tf.tile(tf.expand_dims(tf.range(tf.shape(self.input_seq)[1]), 0), [tf.shape(self.input_seq)[0], 1]),
-                vocab_size=args.maxlen,
-                num_units=args.hidden_units,
-                zero_pad=False,
-                scale=False,
-                l2_reg=args.l2_emb,
-                scope="dec_pos",
-                reuse=reuse,
-                with_t=True
-            )
-            self.seq += t
-
-            # Dropout
-            self.seq = tf.layers.dropout(self.seq,
-                                         rate=self.dropout_rate,
-                                         training=tf.convert_to_tensor(self.is_training),
-                                         seed=args.random_seed)
-
-            self.seq *= mask
-
-            # Build blocks
-            for i in range(args.num_blocks):
-                with tf.variable_scope("num_blocks_%d" % i):
-                    # Self-attention
-                    self.seq = multihead_attention(queries=normalize(self.seq),
-                                                   keys=self.seq,
-                                                   num_units=args.hidden_units,
-                                                   num_heads=args.num_heads,
-                                                   dropout_rate=self.dropout_rate,
-                                                   seed=args.random_seed,
-                                                   is_training=self.is_training,
-                                                   causality=True,
-                                                   scope="self_attention")
-
-                    # Feed forward
-                    self.seq = feedforward(normalize(self.seq), num_units=[args.hidden_units, args.hidden_units],
-                                           dropout_rate=self.dropout_rate, is_training=self.is_training,
-                                           seed=args.random_seed)
-                    self.seq *= mask
-
-            self.seq = normalize(self.seq)
+            self.seq, item_emb_table = self.encoder(self.batch_seq, item_num, self.is_training, self.dropout_rate,
+                                                    reuse)
 
         # find representation
         self.rep = self.seq[:, -1, :]
 
         # define loss
-        seq_emb = tf.reshape(self.rep, [tf.shape(self.input_seq)[0], args.hidden_units])
+        seq_emb = tf.reshape(self.rep, [tf.shape(self.batch_seq)[0], args.hidden_units])
         indices = pos - 1
         self.labels = tf.one_hot(indices, self.max_item)
         item_emb = tf.nn.embedding_lookup(item_emb_table, tf.range(1, self.max_item + 1))
+        self.seq_emb, self.item_emb, self.item_emb_table = seq_emb, item_emb, item_emb_table
         self.logits = tf.matmul(seq_emb, tf.transpose(item_emb))
-        self.loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=self.labels, logits=self.logits))
+        self.loss = tf.reduce_mean(
+            self.weight * tf.nn.softmax_cross_entropy_with_logits(labels=self.labels, logits=self.logits))
 
         self.global_step = tf.Variable(0, name='global_step', trainable=False)
         self.optimizer = tf.train.AdamOptimizer(learning_rate=self.lr)
@@ -100,44 +63,247 @@ class Ader():
         self.test_item = tf.placeholder(tf.int32, shape=None)
         self.test_item_emb = tf.nn.embedding_lookup(item_emb_table, self.test_item)
         self.test_logits = tf.matmul(seq_emb, tf.transpose(self.test_item_emb))
-        self.test_logits = tf.reshape(self.test_logits, [tf.shape(self.input_seq)[0], tf.shape(self.test_item)[0]])
+        self.test_logits = tf.reshape(self.test_logits, [tf.shape(self.batch_seq)[0], tf.shape(self.test_item)[0]])
         self.pred_last = tf.argsort(tf.argsort(-self.test_logits))
+        # rank of target item among candidates: number of candidates scored higher, ties in candidate order
+        self.test_target = tf.placeholder(tf.int32, shape=(None,))
+        target_logits = tf.expand_dims(tf.gather(self.test_logits, self.test_target, batch_dims=1), 1)
+        before_target = tf.expand_dims(tf.range(tf.shape(self.test_item)[0]), 0) < tf.expand_dims(self.test_target, 1)
+        higher = tf.logical_or(self.test_logits > target_logits,
+                               tf.logical_and(tf.equal(self.test_logits, target_logits), before_target))
+        self.test_rank = tf.reduce_sum(tf.to_int32(higher), axis=1)
+
+        if args.distill_mode == 'teacher':
+            # frozen copy of previous period model, computes distillation targets of the exemplars in a batch
+            exemplar_seq = self.batch_seq[tf.shape(self.batch_seq)[0] - tf.shape(self.exemplar_pos)[0]:]
+            with tf.variable_scope("Teacher", reuse=reuse):
+                teacher_seq, teacher_emb_table = self.encoder(exemplar_seq, item_num, False, 0.0, reuse)
+            teacher_item_emb = tf.nn.embedding_lookup(teacher_emb_table, tf.range(1, self.max_item_pre + 1))
+            self.teacher_logits = tf.stop_gradient(tf.matmul(teacher_seq[:, -1, :], tf.transpose(teacher_item_emb)))
+            student_variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='SASRec/')
+            teacher_variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='Teacher/')
+            self.update_teacher = tf.group(*[t.assign(v) for v, t in zip(student_variables, teacher_variables)])
+
+        self.build_train_op()
+
+    def build_exemplar_tables(self):
+        """
+        Build exemplar tables loaded once per period by load_exemplars, a training step only feeds exemplar_batch,
+        the indices of exemplars in the batch. Exemplar inputs and targets can still be fed directly.
+        """
+        logits_dtype = tf.as_dtype(self.args.exemplar_dtype)
+        initial = {'seq': tf.zeros([0, self.args.maxlen], tf.int32),
+                   'pos': tf.zeros([0], tf.int32),
+                   'logits': tf.zeros([0, 0], logits_dtype),
+                   'scale': tf.zeros([0], tf.float32),
+                   'offset': tf.zeros([0], tf.float32),
+                   'index': tf.zeros([0, 0], tf.int32),
+                   'tail': tf.zeros([0], tf.float32)}
+        # local variables are not written to checkpoints
+        self.exemplar_table = {name: tf.Variable(value, trainable=False, validate_shape=False,
+                                                 collections=[tf.GraphKeys.LOCAL_VARIABLES], name='exemplar_' + name)
+                               for name, value in initial.items()}
+        self.exemplar_input = {name: tf.placeholder(value.dtype) for name, value in initial.items()}
+        self.load_exemplar_tables = tf.group(*[tf.assign(self.exemplar_table[name], self.exemplar_input[name],
+                                                         validate_shape=False) for name in initial])
+
+        self.exemplar_batch = tf.placeholder_with_default(tf.zeros([0], tf.int32), shape=(None,))
+        batch = {name: tf.gather(table, self.exemplar_batch) for name, table in self.exemplar_table.items()}
+        logits = tf.to_float(batch['logits']) * tf.expand_dims(batch['scale'], 1) + tf.expand_dims(batch['offset'], 1)
+        self.exemplar_logits = tf.placeholder_with_default(logits, shape=(None, None))
+        self.exemplar_pos = tf.placeholder_with_default(batch['pos'], shape=None)
+        self.exemplar_index = tf.placeholder_with_default(batch['index'], shape=(None, None))
+        self.exemplar_tail = tf.placeholder_with_default(batch['tail'], shape=None)
+
+        # pad input sequences and exemplars to the same length
+        exemplar_seq = batch['seq']
+        length = tf.maximum(tf.shape(self.input_seq)[1],
+                            tf.reduce_max(tf.reduce_sum(tf.to_int32(tf.not_equal(exemplar_seq, 0)), axis=1)))
+        exemplar_seq = exemplar_seq[:, tf.shape(exemplar_seq)[1] - length:]
+        input_seq = tf.pad(self.input_seq, [[0, 0], [length - tf.shape(self.input_seq)[1], 0]])
+        self.batch_seq = tf.concat([input_seq, exemplar_seq], axis=0)
+
+    def load_exemplars(self, sess, seq, pos, store):
+        """
+        Load exemplars of previous period into exemplar tables
+        :param sess: TensorFlow session
+        :param seq: left-padded input sequences of exemplars
+        :param pos: labels of exemplars
+        :param store: exemplar store with logits of exemplars, in the same order
+        """
+        exemplar_num = len(store)
+        values = {'seq': seq,
+                  'pos': pos,
+                  'logits': np.asarray(store.logits),
+                  'scale': store.scale if store.scale is not None else np.ones(exemplar_num, np.float32),
+                  'offset': store.offset if store.offset is not None else np.zeros(exemplar_num, np.float32),
+                  'index': np.asarray(store.indices) if store.indices is not None
+                  else np.zeros((exemplar_num, 0), np.int32),
+                  'tail': store.tail if store.tail is not None else np.zeros(exemplar_num, np.float32)}
+        sess.run(self.load_exemplar_tables, {self.exemplar_input[name]: value for name, value in values.items()})
 
-    def set_vanilla_loss(self):
-        self.train_op = self.optimizer.minimize(self.loss, global_step=self.global_step)
+    def encoder(self, input_seq, item_num, is_training, dropout_rate, reuse=None):
+        """
+        Self-attentive encoder of item sequences
+        :param input_seq: left-padded input item sequences
+        :param item_num: number of items
+        :param is_training: if True, apply dropout
+        :param dropout_rate: dropout rate
+        :param reuse: reuse variables
+        :return: encoded sequences and item embedding table
+        """
+        mask = tf.expand_dims(tf.to_float(tf.not_equal(input_seq, 0)), -1)
+
+        # sequence embedding, item embedding table
+        seq, item_emb_table = embedding(input_seq,
+                                        vocab_size=item_num + 1,
+                                        num_units=self.args.hidden_units,
+                                        zero_pad=True,
+                                        scale=True,
+                                        l2_reg=self.args.l2_emb,
+                                        scope="input_embeddings",
+                                        with_t=True,
+                                        reuse=reuse
+                                        )
+
+        # # Positional Encoding, sequences are left-padded so the last item always has position maxlen - 1
+        t, pos_emb_table = embedding(
+            tf.tile(tf.expand_dims(tf.range(self.args.maxlen - tf.shape(input_seq)[1], self.args.maxlen), 0),
+                    [tf.shape(input_seq)[0], 1]),
+            vocab_size=self.args.maxlen,
+            num_units=self.args.hidden_units,
+            zero_pad=False,
+            scale=False,
+            l2_reg=self.args.l2_emb,
+            scope="dec_pos",
+            reuse=reuse,
+            with_t=True
+        )
+        seq += t
+
+        # Dropout
+        seq = tf.layers.dropout(seq,
+                                rate=dropout_rate,
+                                training=tf.convert_to_tensor(is_training),
+                                seed=self.args.random_seed)
+
+        seq *= mask
+
+        # Build blocks
+        for i in range(self.args.num_blocks):
+            with tf.variable_scope("num_blocks_%d" % i):
+                # Self-attention
+                seq = multihead_attention(queries=normalize(seq),
+                                          keys=seq,
+                                          num_units=self.args.hidden_units,
+                                          num_heads=self.args.num_heads,
+                                          dropout_rate=dropout_rate,
+                                          seed=self.args.random_seed,
+                                          is_training=is_training,
+                                          causality=True,
+                                          scope="self_attention")
 
-    def update_loss(self, lambda_):
+                # Feed forward
+                seq = feedforward(normalize(seq), num_units=[self.args.hidden_units, self.args.hidden_units],
+                                  dropout_rate=dropout_rate, is_training=is_training,
+                                  seed=self.args.random_seed)
+                seq *= mask
+
+        seq = normalize(seq)
+
+        return seq, item_emb_table
+
+    def sampled_loss(self, seq_emb, pos, weight):
         """
-        Update exemplar loss
+        Cross-entropy of labels against sampled negative items instead of all items
+        :param seq_emb: representations of input sequences
+        :param pos: labels
+        :param weight: loss weights
+        :return: mean weighted loss
+        """
+        pos = tf.reshape(pos, [-1])
+        if self.args.train_softmax == 'sampled':
+            # item numbers follow first appearance rather than popularity, so negatives are drawn uniformly
+            candidates = tf.random.uniform([self.args.num_sampled], 1, self.max_item + 1, dtype=tf.int32,
+                                           seed=self.args.random_seed)
+        elif self.args.train_softmax == 'inbatch':
+            # labels of the other sub-sequences in the batch are negatives
+            candidates = pos
+        else:
+            raise ValueError('Invalid training softmax %s' % self.args.train_softmax)
+        true_logits = tf.reduce_sum(seq_emb * tf.nn.embedding_lookup(self.item_emb_table, pos), axis=1,
+                                    keepdims=True)
+        sampled_logits = tf.matmul(seq_emb, tf.transpose(tf.nn.embedding_lookup(self.item_emb_table, candidates)))
+        if self.args.train_softmax == 'inbatch':
+            # in-batch negatives are drawn by label frequency, logQ correction with their frequency in the batch
+            _, index, counts = tf.unique_with_counts(pos)
+            log_q = tf.log(tf.to_float(tf.gather(counts, index)) / tf.to_float(tf.shape(pos)[0]))
+            true_logits -= tf.expand_dims(log_q, 1)
+            sampled_logits -= tf.expand_dims(log_q, 0)
+        # a negative equal to the label is removed
+        sampled_logits -= 1e9 * tf.to_float(tf.equal(tf.expand_dims(pos, 1), tf.expand_dims(candidates, 0)))
+        logits = tf.concat([true_logits, sampled_logits], axis=1)
+        return tf.reduce_mean(weight * tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tf.zeros_like(pos),
+                                                                                       logits=logits))
+
+    def train_variables(self):
+        """
+        Trainable variables of the model, the teacher stays frozen
+        """
+        return [v for v in tf.trainable_variables() if not v.name.startswith('Teacher/')]
+
+    def build_train_op(self):
+        """
+        Build loss and train op once, the exemplar loss is weighted by lambda_, which is 0 without exemplars
         """
         # find the number of train data from current cycle
-        if self.args.disable_distillation:
-            train_size = tf.shape(self.input_seq)[0] - tf.shape(self.exemplar_pos)[0]
+        if self.args.disable_distillation or self.args.distill_mode == 'teacher':
+            train_size = tf.shape(self.batch_seq)[0] - tf.shape(self.exemplar_pos)[0]
         else:
-            train_size = tf.shape(self.input_seq)[0] - tf.shape(self.exemplar_logits)[0]
+            train_size = tf.shape(self.batch_seq)[0] - tf.shape(self.exemplar_logits)[0]
 
         # training data
-        train_logits = self.logits[:train_size]
-        train_labels = self.labels[:train_size]
-        self.exemp_loss = tf.reduce_mean(
-            tf.nn.softmax_cross_entropy_with_logits(labels=train_labels, logits=train_logits))
+        if self.args.train_softmax == 'full':
+            train_logits = self.logits[:train_size]
+            train_labels = self.labels[:train_size]
+            self.train_loss = tf.reduce_mean(
+                self.weight * tf.nn.softmax_cross_entropy_with_logits(labels=train_labels, logits=train_logits))
+
+            # exemplar data
+            exemplar_logits = self.logits[train_size:]
+        else:
+            self.train_loss = self.sampled_loss(self.seq_emb[:train_size], self.pos, self.weight)
 
-        # exemplar data
-        exemplar_logits = self.logits[train_size:]
+            # exemplar data, all items are only scored for exemplars
+            exemplar_logits = tf.matmul(self.seq_emb[train_size:], tf.transpose(self.item_emb))
 
         if self.args.disable_distillation:
             # one-hot label
             indices = self.exemplar_pos - 1
             exemplar_labels = tf.one_hot(indices, self.max_item)
-            self.exemp_loss += lambda_ * tf.reduce_mean(
-                tf.nn.softmax_cross_entropy_with_logits(labels=exemplar_labels, logits=exemplar_logits))
+        elif self.args.distill_mode == 'teacher':
+            # logits-matching, targets from frozen previous period model
+            exemplar_logits = exemplar_logits[:, :self.max_item_pre]
+            exemplar_labels = tf.nn.softmax(self.teacher_logits)
+        elif self.args.distill_topk > 0:
+            # logits-matching on top-K items of previous model, other items are merged into one tail class
+            log_prob = tf.nn.log_softmax(exemplar_logits[:, :self.max_item_pre])
+            top_log_prob = tf.gather(log_prob, self.exemplar_index, batch_dims=1)
+            tail_log_prob = tf.log(tf.maximum(1.0 - tf.reduce_sum(tf.exp(top_log_prob), axis=1), 1e-12))
+            top_labels = tf.expand_dims(1.0 - self.exemplar_tail, 1) * tf.nn.softmax(self.exemplar_logits)
+            exemplar_loss = -tf.reduce_sum(top_labels * top_log_prob, axis=1) - self.exemplar_tail * tail_log_prob
         else:
             # logits-matching
             exemplar_logits = exemplar_logits[:, :tf.shape(self.exemplar_logits)[1]]
             exemplar_labels = tf.nn.softmax(self.exemplar_logits)
-            self.exemp_loss += lambda_ * tf.reduce_mean(
-                tf.nn.softmax_cross_entropy_with_logits(labels=exemplar_labels, logits=exemplar_logits))
-        self.train_op = self.optimizer.minimize(self.exemp_loss, global_step=self.global_step)
+        if self.args.disable_distillation or self.args.distill_mode == 'teacher' or self.args.distill_topk <= 0:
+            # cross-entropy written out, softmax_cross_entropy_with_logits fails on batches without exemplars
+            exemplar_loss = -tf.reduce_sum(exemplar_labels * tf.nn.log_softmax(exemplar_logits), axis=1)
+        # mean over exemplars, 0 without exemplars
+        exemplar_num = tf.maximum(tf.to_float(tf.shape(exemplar_loss)[0]), 1.0)
+        self.exemp_loss = self.train_loss + self.lambda_ * tf.reduce_sum(exemplar_loss) / exemplar_num
+        self.train_op = self.optimizer.minimize(self.exemp_loss, global_step=self.global_step,
+                                                var_list=self.train_variables())
 
     def predict(self, sess, seq, item_idx):
         """
@@ -151,3 +317,38 @@ class Ader():
                                          self.test_item: item_idx,
                                          self.is_training: False,
                                          self.dropout_rate: self.args.dropout_rate})
+
+    def predict_rank(self, sess, seq, item_idx, target):
+        """
+        Predict rank of target item
+        :param sess: TensorFlow session
+        :param seq: input item sequence (session)
+        :param item_idx: candidate item index
+        :param target: position of target item in candidate item index
+        :return: rank of target item, starting from 0
+        """
+        return sess.run(self.test_rank, {self.input_seq: seq,
+                                         self.test_item: item_idx,
+                                         self.test_target: target,
+                                         self.is_training: False,
+                                         self.dropout_rate: self.args.dropout_rate})
+
+    def item_embeddings(self, sess, max_item):
+        """
+        Get embeddings of current items, to score all items outside the graph
+        :param sess: TensorFlow session
+        :param max_item: current period item number
+        :return: item embedding matrix, max_item * hidden units
+        """
+        return sess.run(self.item_emb_table)[1:max_item + 1]
+
+    def predict_rep(self, sess, seq):
+        """
+        Predict representation of input sequences
+        :param sess: TensorFlow session
+        :param seq: input item sequence (session)
+        :return: representation of input sequences, batch size * hidden units
+        """
+        return sess.run(self.seq_emb, {self.input_seq: seq,
+                                       self.is_training: False,
+                                       self.dropout_rate: self.args.dropout_rate})
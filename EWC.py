@@ -16,13 +16,18 @@ class Ewc():
     def __init__(self, item_num, args, reuse=None):
         self.args = args
         self.is_training = tf.placeholder(tf.bool, shape=())
-        self.input_seq = tf.placeholder(tf.int32, shape=(None, args.maxlen))
+        # input length can be shorter than maxlen when batches are trimmed to their longest sequence
+        self.input_seq = tf.placeholder(tf.int32, shape=(None, None))
         self.pos = tf.placeholder(tf.int32, shape=None)
+        # per-example loss weight, e.g. the count of a collapsed duplicate example, defaults to 1
+        self.weight = tf.placeholder_with_default(tf.ones_like(self.pos, dtype=tf.float32), shape=(None,))
         self.exemplar_logits = tf.placeholder(tf.float32, shape=(None, None))
         self.exemplar_pos = tf.placeholder(tf.int32, shape=None)
         self.max_item = tf.placeholder(tf.int32, shape=())
         self.max_item_pre = tf.placeholder(tf.int32, shape=())
         self.lr = tf.placeholder(tf.float32, shape=())
+        # weight of EWC penalty, 0 for training without penalty
+        self.lambda_ = tf.placeholder_with_default(0.0, shape=())
         self.dropout_rate = tf.placeholder(tf.float32, shape=())
         pos = self.pos
         mask = tf.expand_dims(tf.to_float(tf.not_equal(self.input_seq, 0)), -1)
@@ -40,9 +45,10 @@ class Ewc():
                                                  reuse=reuse
                                                  )
 
-            # # Positional Encoding
+            # # Positional Encoding, sequences are left-padded so the last item always has position maxlen - 1
             t, pos_emb_table = embedding(
-                tf.tile(tf.expand_dims(tf.range(tf.shape(self.input_seq)[1]), 0), [tf.shape(self.input_seq)[0], 1]),
+                tf.tile(tf.expand_dims(tf.range(args.maxlen - tf.shape(self.input_seq)[1], args.maxlen), 0),
+                        [tf.shape(self.input_seq)[0], 1]),
                 vocab_size=args.maxlen,
                 num_units=args.hidden_units,
                 zero_pad=False,
@@ -95,8 +101,10 @@ class Ewc():
         indices = pos - 1
         self.labels = tf.one_hot(indices, self.max_item)
         item_emb = tf.nn.embedding_lookup(item_emb_table, tf.range(1, self.max_item + 1))
+        self.seq_emb, self.item_emb_table = seq_emb, item_emb_table
         self.logits = tf.matmul(seq_emb, tf.transpose(item_emb))
-        self.loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=self.labels, logits=self.logits))
+        self.loss = tf.reduce_mean(
+            self.weight * tf.nn.softmax_cross_entropy_with_logits(labels=self.labels, logits=self.logits))
         self.gradient = tf.gradients(self.loss, self.variables)
 
         self.global_step = tf.Variable(0, name='global_step', trainable=False)
@@ -108,22 +116,46 @@ class Ewc():
         self.test_logits = tf.matmul(seq_emb, tf.transpose(self.test_item_emb))
         self.test_logits = tf.reshape(self.test_logits, [tf.shape(self.input_seq)[0], tf.shape(self.test_item)[0]])
         self.pred_last = tf.argsort(tf.argsort(-self.test_logits))
+        # rank of target item among candidates: number of candidates scored higher, ties in candidate order
+        self.test_target = tf.placeholder(tf.int32, shape=(None,))
+        target_logits = tf.expand_dims(tf.gather(self.test_logits, self.test_target, batch_dims=1), 1)
+        before_target = tf.expand_dims(tf.range(tf.shape(self.test_item)[0]), 0) < tf.expand_dims(self.test_target, 1)
+        higher = tf.logical_or(self.test_logits > target_logits,
+                               tf.logical_and(tf.equal(self.test_logits, target_logits), before_target))
+        self.test_rank = tf.reduce_sum(tf.to_int32(higher), axis=1)
 
-    def set_vanilla_loss(self):
+        self.build_train_op()
 
-        self.train_op = self.optimizer.minimize(self.loss, global_step=self.global_step)
-
-    def update_loss(self, lambda_):
+    def build_train_op(self):
         """
-        Update loss to EWC loss
+        Build EWC loss and train op once, the penalty is weighted by lambda_ and uses fisher information and
+        variables of previous period loaded by load_penalty
         """
+        # local variables are not written to checkpoints
+        self.fisher = [tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype), trainable=False,
+                                   collections=[tf.GraphKeys.LOCAL_VARIABLES]) for v in self.variables]
+        self.previous = [tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype), trainable=False,
+                                     collections=[tf.GraphKeys.LOCAL_VARIABLES]) for v in self.variables]
+        self.penalty_input = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in self.fisher + self.previous]
+        self.load_penalty_op = tf.group(*[v.assign(value) for v, value in zip(self.fisher + self.previous,
+                                                                             self.penalty_input)])
+
         self.ewc_loss = self.loss
         for v in range(len(self.variables)):
-            self.ewc_loss += (lambda_ / 2.0) * \
-                             tf.reduce_sum(tf.multiply(self.F_accum[v].astype(np.float32),
-                                                       tf.square(self.variables[v] - self.variables_prev[v])))
+            self.ewc_loss += (self.lambda_ / 2.0) * \
+                             tf.reduce_sum(tf.multiply(self.fisher[v],
+                                                       tf.square(self.variables[v] - self.previous[v])))
         self.train_op = self.optimizer.minimize(self.ewc_loss, global_step=self.global_step)
 
+    def load_penalty(self, sess):
+        """
+        Load fisher information and variables of previous period into the EWC penalty
+        :param sess: TensorFlow session
+        """
+        values = self.F_accum + self.variables_prev
+        sess.run(self.load_penalty_op, {value: np.asarray(array, dtype=value.dtype.as_numpy_dtype)
+                                        for value, array in zip(self.penalty_input, values)})
+
     def compute_fisher(self, sess, data, batch_size, max_item):
         """
         Compute Fisher information for each parameter
@@ -176,3 +208,38 @@ class Ewc():
                                          self.test_item: item_idx,
                                          self.is_training: False,
                                          self.dropout_rate: self.args.dropout_rate})
+
+    def predict_rank(self, sess, seq, item_idx, target):
+        """
+        Predict rank of target item
+        :param sess: TensorFlow session
+        :param seq: input item sequence (session)
+        :param item_idx: candidate item index
+        :param target: position of target item in candidate item index
+        :return: rank of target item, starting from 0
+        """
+        return sess.run(self.test_rank, {self.input_seq: seq,
+                                         self.test_item: item_idx,
+                                         self.test_target: target,
+                                         self.is_training: False,
+                                         self.dropout_rate: self.args.dropout_rate})
+
+    def item_embeddings(self, sess, max_item):
+        """
+        Get embeddings of current items, to score all items outside the graph
+        :param sess: TensorFlow session
+        :param max_item: current period item number
+        :return: item embedding matrix, max_item * hidden units
+        """
+        return sess.run(self.item_emb_table)[1:max_item + 1]
+
+    def predict_rep(self, sess, seq):
+        """
+        Predict representation of input sequences
+        :param sess: TensorFlow session
+        :param seq: input item sequence (session)
+        :return: representation of input sequences, batch size * hidden units
+        """
+        return sess.run(self.seq_emb, {self.input_seq: seq,
+                                       self.is_training: False,
+                                       self.dropout_rate: self.args.dropout_rate})
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Project      : ADER
+# @File         : checkpoint.py
+# @Description  : In-memory model snapshots and checkpoint writing.
+# @Author       : Xiaoyu Lin
+
+import threading
+import tensorflow.compat.v1 as tf
+
+
+class WeightSnapshot:
+    """ This object keeps a copy of variables in host memory, so that the weights of the best epoch can be restored
+    in the same session without reading a checkpoint. Assign operations are built once at construction.
+    """
+
+    def __init__(self, variables):
+        """
+        :param variables: variables to snapshot, e.g. all global variables
+        """
+        self.variables = variables
+        self.inputs = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in variables]
+        self.restore_op = tf.group(*[v.assign(value) for v, value in zip(variables, self.inputs)])
+        self.values = None
+
+    def save(self, sess):
+        """
+        Copy current values of variables into host memory
+        :param sess: TensorFlow session
+        """
+        self.values = sess.run(self.variables)
+
+    def restore(self, sess):
+        """
+        Assign the saved values to variables
+        :param sess: TensorFlow session
+        """
+        sess.run(self.restore_op, dict(zip(self.inputs, self.values)))
+
+
+class Checkpointer:
+    """ This object writes checkpoints from a copy of variables kept next to them, so that training goes on while
+    a background thread writes the copy. One checkpoint is written at a time, the number of checkpoints kept per
+    period is bounded.
+    """
+
+    def __init__(self, variables, max_to_keep=1, background=True):
+        """
+        :param variables: variables to save, e.g. all global variables, or model weights only for inference
+        :param max_to_keep: number of checkpoints kept in each period
+        :param background: if True, checkpoints are written in a background thread
+        """
+        # local variables are not saved by other savers and snapshots
+        self.copies = [tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype), trainable=False,
+                                   collections=[tf.GraphKeys.LOCAL_VARIABLES]) for v in variables]
+        self.copy_op = tf.group(*[copy.assign(v) for copy, v in zip(self.copies, variables)])
+        # checkpoints use the names of the original variables, so they are restored by a saver of the model
+        self.saver = tf.train.Saver({v.op.name: copy for v, copy in zip(variables, self.copies)},
+                                    max_to_keep=max_to_keep)
+        self.background = background
+        self.thread = None
+        self.error = None
+
+    def save(self, sess, path):
+        """
+        Copy variables and write them into a checkpoint, after the previous checkpoint is written
+        :param sess: TensorFlow session
+        :param path: checkpoint path
+        """
+        self.wait()
+        sess.run(self.copy_op)
+        if self.background:
+            self.thread = threading.Thread(target=self.write, args=(sess, path), daemon=True)
+            self.thread.start()
+        else:
+            self.write(sess, path)
+
+    def write(self, sess, path):
+        """
+        Write copied variables into a checkpoint, the raised exception is kept for wait
+        :param sess: TensorFlow session
+        :param path: checkpoint path
+        """
+        try:
+            self.saver.save(sess, path, write_meta_graph=False)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Wait until the checkpoint being written is finished
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def new_period(self):
+        """
+        Start retention of a new period, checkpoints of previous periods are kept
+        """
+        self.wait()
+        self.saver.set_last_checkpoints_with_time([])
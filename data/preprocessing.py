@@ -4,9 +4,13 @@
 # @File         : preprocessing.py
 
 import argparse
+import sys
 import os
+import numpy as np
 from util import *
 
+STATE_FILE = 'preprocess_state.pkl'
+
 
 def str2bool(v):
     """
@@ -24,109 +28,118 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-def read_data(dataset_path):
+def read_data(dataset_path, chunk_size=1000000, workers=1, sess_map=None, item_map=None, converter=None):
     """
     Load data from raw dataset.
     :param dataset_path: the full name of dataset including extension name
+    :param chunk_size: number of rows parsed at once
+    :param workers: number of processes parsing the dataset in parallel
+    :param sess_map: existing session map when appending new data, None for a new map
+    :param item_map: existing item map when appending new data, None for a new map
+    :param converter: DIGINETICA timeframe converter of existing data, None to derive it from the dataset
     :return sess_map: map from raw data session name to session Id, a dictionary sess_map[sess_name]=sessId
     :return item_map: map from raw data item name to item Id, a dictionary item_map[item_name]=itemId
-    :return reformed_data: a list: each element is a action, which is a list of [sessId, itemId, time]
+    :return reformed_data: a tuple of aligned column arrays (sessId, itemId, time), one entry per action
+    :return converter: DIGINETICA timeframe converter, None for other datasets
     """
     # load data according to file extension name
     filename_extension = dataset_path.split('/')[-1].split('.')[-1]
     if filename_extension == 'dat':
-        sess_map, item_map, reformed_data = read_dat(dataset_path)
+        sess_map, item_map, reformed_data = read_dat(dataset_path, chunk_size, workers, sess_map, item_map)
     elif filename_extension == 'csv':
-        sess_map, item_map, reformed_data = read_csv(dataset_path)
+        sess_map, item_map, reformed_data, converter = read_csv(dataset_path, chunk_size, workers,
+                                                                sess_map, item_map, converter)
     else:
         print("Error: new data file type !!!")
 
     # print raw dataset information
+    action_num = len(reformed_data[0])
     print('Total number of sessions in dataset:', len(sess_map.keys()))
     print('Total number of items in dataset:', len(item_map.keys()))
-    print('Total number of actions in dataset:', len(reformed_data))
-    print('Average number of actions per user:', len(reformed_data) / len(sess_map.keys()))
-    print('Average number of actions per item:', len(reformed_data) / len(item_map.keys()))
+    print('Total number of actions in dataset:', action_num)
+    print('Average number of actions per user:', action_num / len(sess_map.keys()))
+    print('Average number of actions per item:', action_num / len(item_map.keys()))
 
-    return sess_map, item_map, reformed_data
+    return sess_map, item_map, reformed_data, converter
 
 
-def short_remove(reformed_data, args):
+def short_remove(reformed_data, args, item_counter=None):
     """
     Remove data according to threshold
-    :param reformed_data: loaded data, a list: each element is a action, which is a list of [sessId, itemId, time]
+    :param reformed_data: loaded data, a tuple of aligned column arrays (sessId, itemId, time)
     :param args: args.threshold_item: minimum number of appearance time of item -1
                  args.threshold_sess: minimum length of session -1
                  args.yoochoose_select: select a most recent fraction of entire dataset
-    :return removed_data: result data after removing
-    :return sess_end: a map recording session end time, a dictionary sess_end[sessId]=end_time
+    :param item_counter: item occurrences in previously processed data, added to the occurrences in this data
+    :return removed_data: result data after removing, a tuple of aligned column arrays (sessId, itemId, time)
+    :return sess_end: an array recording session end time, sess_end[sessId]=end_time, NaN for removed sessions
+    :return item_counter: accumulated item occurrences, item_counter[itemId]=count, after removing length-1 sessions
     """
-    org_sess_end = dict()
-    for [userId, _, time] in reformed_data:
-        org_sess_end = generate_sess_end_map(org_sess_end, userId, time)
+    sess, item, time = reformed_data
+    sess_num = sess.max() + 1
+    item_num = item.max() + 1
 
     # remove session whose length is 1
-    sess_counter = defaultdict(lambda: 0)
-    for [userId, _, _] in reformed_data:
-        sess_counter[userId] += 1
-    removed_data = list(filter(lambda x: sess_counter[x[0]] > 1, reformed_data))
+    sess_counter = np.bincount(sess, minlength=sess_num)
+    keep = sess_counter[sess] > 1
+    sess, item, time = sess[keep], item[keep], time[keep]
 
     # remove item which appear less or equal to threshold_item
-    item_counter = defaultdict(lambda: 0)
-    for [_, itemId, _] in removed_data:
-        item_counter[itemId] += 1
-    removed_data = list(filter(lambda x: item_counter[x[1]] > args.threshold_item, removed_data))
+    history_counter = np.zeros(0, dtype=np.int64) if item_counter is None else item_counter
+    item_counter = np.bincount(item, minlength=max(item_num, len(history_counter)))
+    item_counter[:len(history_counter)] += history_counter
+    keep = item_counter[item] > args.threshold_item
+    sess, item, time = sess[keep], item[keep], time[keep]
 
     # remove session whose length less or equal to threshold_sess
-    sess_counter = defaultdict(lambda: 0)
-    for [userId, _, _] in removed_data:
-        sess_counter[userId] += 1
-    removed_data = list(filter(lambda x: sess_counter[x[0]] > args.threshold_sess, removed_data))
+    sess_counter = np.bincount(sess, minlength=sess_num)
+    keep = sess_counter[sess] > args.threshold_sess
+    sess, item, time = sess[keep], item[keep], time[keep]
 
     # record session end time
-    sess_end = dict()
-    for [userId, _, time] in removed_data:
-        sess_end = generate_sess_end_map(sess_end, userId, time)
+    sess_end = generate_sess_end(sess, time, sess_num)
 
     # if yoochoose dataset, choose a most recent fraction of entire dataset
     if args.yoochoose_select < 1.0 and args.dataset == 'yoochoose-clicks.dat':
-        max_time = max(map(lambda x: x[2], removed_data))
+        max_time = time.max()
         if args.test_fraction == 'day':
             test_threshold = 86400
         elif args.test_fraction == 'week':
             test_threshold = 86400 * 7
 
-        train_session_times = []
-        for userId in sess_end.keys():
-            if sess_counter[userId] > 1 and sess_end[userId] <= max_time - test_threshold:
-                for _ in range(sess_counter[userId]-1):
-                    train_session_times.append(sess_end[userId])
+        with np.errstate(invalid='ignore'):
+            train_sess = (sess_counter > 1) & (sess_end <= max_time - test_threshold)
+        train_session_times = np.repeat(sess_end[train_sess], sess_counter[train_sess] - 1)
         threshold = np.percentile(train_session_times, (1.0 - args.yoochoose_select) * 100.0, interpolation='lower')
-        removed_data = list(filter(lambda x: sess_end[x[0]] >= threshold, removed_data))
+        keep = sess_end[sess] >= threshold
+        sess, item, time = sess[keep], item[keep], time[keep]
 
     # print information of removed data
-    print('Number of sessions after pre-processing:', len(set(map(lambda x: x[0], removed_data))))
-    print('Number of items after pre-processing:', len(set(map(lambda x: x[1], removed_data))))
-    print('Number of actions after pre-processing:', len(removed_data))
-    print('Average number of actions per session:', len(removed_data) / len(set(map(lambda x: x[0], removed_data))))
-    print('Average number of actions per item:', len(removed_data) / len(set(map(lambda x: x[1], removed_data))))
+    sess_num_removed = np.count_nonzero(np.bincount(sess))
+    item_num_removed = np.count_nonzero(np.bincount(item))
+    print('Number of sessions after pre-processing:', sess_num_removed)
+    print('Number of items after pre-processing:', item_num_removed)
+    print('Number of actions after pre-processing:', len(sess))
+    print('Average number of actions per session:', len(sess) / sess_num_removed)
+    print('Average number of actions per item:', len(sess) / item_num_removed)
 
-    return removed_data, sess_end
+    return (sess, item, time), sess_end, item_counter
 
 
 def time_partition(removed_data, session_end, args):
     """
     Partition data according to time periods
-    :param removed_data: input data, a list: each element is a action, which is a list of [sessId, itemId, time]
-    :param session_end: a dictionary recording session end time, session_end[sessId]=end_time
+    :param removed_data: input data, a tuple of aligned column arrays (sessId, itemId, time)
+    :param session_end: an array recording session end time, session_end[sessId]=end_time, NaN for removed sessions
     :param : args: args.test_fraction: time interval for each partition
-    :return: time_fraction: a dictionary, the keys are different time periods, value is a list of actions in that
-                            time period
+    :return: time_fraction: a dictionary, the keys are different time periods, value is a tuple of aligned column
+                            arrays (sessId, itemId, time) of actions in that time period
     """
     if args.is_time_fraction:
         # split entire dataset by time interval
         time_fraction = dict()
-        all_times = np.array(list(session_end.values()))
+        sess, item, time = removed_data
+        all_times = session_end[~np.isnan(session_end)].astype(time.dtype)
         max_time = max(all_times)
         min_time = min(all_times)
 
@@ -153,16 +166,16 @@ def time_partition(removed_data, session_end, args):
             period_threshold = period_threshold[1:]
             period_threshold = period_threshold[:17]
 
-        for [sessId, itemId, time] in removed_data:
-            # find period of each action
-            if args.dataset == 'yoochoose-clicks.dat' and time > period_threshold[-1]:
-                continue
-            period = period_threshold.searchsorted(time) + 1
-            # generate time period for dictionary keys
-            if period not in time_fraction:
-                time_fraction[period] = []
-            # partition data according to period
-            time_fraction[period].append([sessId, itemId, time])
+        # find period of each action
+        period = period_threshold.searchsorted(time) + 1
+        if args.dataset == 'yoochoose-clicks.dat':
+            period[time > period_threshold[-1]] = 0
+        # partition data according to period, keeping the original order of actions inside each period
+        order = np.argsort(period, kind='stable')
+        bounds = np.flatnonzero(np.diff(period[order])) + 1
+        for indices in np.split(order, bounds):
+            if len(indices) and period[indices[0]] > 0:
+                time_fraction[period[indices[0]]] = (sess[indices], item[indices], time[indices])
     else:
         # if not partition, put all actions in the last period
         time_fraction = removed_data
@@ -170,60 +183,82 @@ def time_partition(removed_data, session_end, args):
     return time_fraction
 
 
-def generating_txt(time_fraction, sess_end, args):
+def generating_txt(time_fraction, sess_end, args, item_map=None, first_period=0):
     """
     Generate final txt file
     :param time_fraction: input data, a dictionary, the keys are different time periods,
-                          value is a list of actions in that time period
-    :param sess_end: session end time map, sess_map[sessId]=end_time
+                          value is a tuple of aligned column arrays (sessId, itemId, time) in that time period
+    :param sess_end: session end time array, sess_end[sessId]=end_time
     :param : args: args.test_fraction: if not split, time interval for test partition
+                   args.workers: number of processes writing files in parallel
+    :param item_map: final item map of previously generated periods when appending a period, None for a new map
+    :param first_period: number of the first generated period file
+    :return: item_map: final item map, a dictionary item_map[itemId]=final itemId
     """
 
     if args.is_time_fraction:
-        # item map second time
-        item_map = {}
+        # item map second time, visit actions of each period ordered by session end time
+        item_map = {} if item_map is None else item_map
         for period in sorted(time_fraction.keys()):
-            time_fraction[period].sort(key=lambda x: sess_end[x[0]])
-        for period in sorted(time_fraction.keys()):
-            for i, [userId, itemId, time] in enumerate(time_fraction[period]):
-                itemId = generate_name_Id_map(itemId, item_map)
-                time_fraction[period][i] = [userId, itemId, time]
+            sess, item, time = time_fraction[period]
+            order = np.argsort(sess_end[sess], kind='stable')
+            time_fraction[period] = (sess[order], encode_name_Id(item[order], item_map), time[order])
 
         # sort action according to time sequence
         for period in sorted(time_fraction.keys()):
-            time_fraction[period].sort(key=lambda x: x[2])
+            sess, item, time = time_fraction[period]
+            order = np.argsort(time, kind='stable')
+            time_fraction[period] = (sess[order], item[order], time[order])
 
         # generate text file
+        jobs = []
         for i, period in enumerate(sorted(time_fraction.keys())):
-            with open('period_' + str(i) + '.txt', 'w') as file_train:
-                for [userId, itemId, time] in time_fraction[period]:
-                    file_train.write('%d %d\n' % (userId, itemId))
+            sess, item, _ = time_fraction[period]
+            jobs.append(('period_' + str(first_period + i), sess, item))
+        parallel_starmap(write_period, jobs, args.workers)
     else:
         # item map second time
         item_map = {}
-        time_fraction.sort(key=lambda x: x[2])
-        for i, [userId, itemId, time] in enumerate(time_fraction):
-            itemId = generate_name_Id_map(itemId, item_map)
-            time_fraction[i] = [userId, itemId, time]
-
-        # sort action according to time sequence
-        time_fraction.sort(key=lambda x: x[2])
+        sess, item, time = time_fraction
+        order = np.argsort(time, kind='stable')
+        sess, item, time = sess[order], encode_name_Id(item[order], item_map), time[order]
 
-        max_time = max(map(lambda x: x[2], time_fraction))
+        max_time = time.max()
         if args.test_fraction == 'day':
             test_threshold = 86400
         elif args.test_fraction == 'week':
             test_threshold = 86400 * 7
 
         # generate text file
-        item_set = set()
-        with open('test.txt', 'w') as file_test, open('train.txt', 'w') as file_train:
-            for [userId, itemId, time] in time_fraction:
-                if sess_end[userId] < max_time - test_threshold:
-                    file_train.write('%d %d\n' % (userId, itemId))
-                    item_set.add(itemId)
-                else:
-                    file_test.write('%d %d\n' % (userId, itemId))
+        is_train = sess_end[sess] < max_time - test_threshold
+        jobs = [('train', sess[is_train], item[is_train]), ('test', sess[~is_train], item[~is_train])]
+        parallel_starmap(write_period, jobs, args.workers)
+
+    return item_map
+
+
+def append_period(reformed_data, state, args):
+    """
+    Append new data as the next period, using the state of previously processed data so that item Ids stay
+    consistent. Only the new data is filtered, sorted and written, sessions are counted within the new data.
+    :param reformed_data: new data, a tuple of aligned column arrays (sessId, itemId, time)
+    :param state: preprocessing state saved by the last run, updated in place
+    :param args: thresholds as in short_remove
+    """
+    # remove data according to occurrences time, items are counted over all processed data
+    removed_data, sess_end, state['item_counter'] = short_remove(reformed_data, args, state['item_counter'])
+
+    # sessions continuing from previous data keep their latest end time
+    prev_sess_end = state['sess_end']
+    if len(prev_sess_end) > len(sess_end):
+        sess_end = np.append(sess_end, np.full(len(prev_sess_end) - len(sess_end), np.nan))
+    sess_end[:len(prev_sess_end)] = np.fmax(sess_end[:len(prev_sess_end)], prev_sess_end)
+    state['sess_end'] = sess_end
+
+    # all new actions form the next period
+    state['final_item_map'] = generating_txt({1: removed_data}, sess_end, args,
+                                             state['final_item_map'], state['period_num'])
+    state['period_num'] += 1
 
 
 if __name__ == '__main__':
@@ -235,6 +270,10 @@ if __name__ == '__main__':
     parser.add_argument('--threshold_sess', default=1, type=int)  # minimum number of appearance time of item -1
     parser.add_argument('--threshold_item', default=4, type=int)  # minimum length of session -1
     parser.add_argument('--yoochoose_select', default=1.0, type=float)  # select most recent portion in yoochoose
+    parser.add_argument('--chunk_size', default=1000000, type=int)  # number of raw rows parsed at once
+    parser.add_argument('--convert_txt', default=False, type=str2bool)  # only write binary files for existing txt
+    parser.add_argument('--workers', default=1, type=int)  # number of processes, output is the same for any number
+    parser.add_argument('--append', default='', type=str)  # new raw data file appended as the next period
     args = parser.parse_args()
     print('Start preprocess ' + args.dataset + ':')
 
@@ -242,10 +281,6 @@ if __name__ == '__main__':
     SEED = 666
     np.random.seed(SEED)
 
-    # load data and get the session and item lookup table
-    os.chdir('dataset')
-    sess_map, item_map, reformed_data = read_data(args.dataset)
-
     # create dictionary for processed data
     if args.dataset.split('.')[0] == 'yoochoose-clicks':
         dataset_name = 'YOOCHOOSE'
@@ -255,17 +290,49 @@ if __name__ == '__main__':
         dataset_name = dataset_name
     else:
         dataset_name = dataset_name + '_joint'
+
+    if args.convert_txt:
+        # write binary period files next to already generated txt files
+        os.chdir(dataset_name)
+        for file_name in sorted(filter(lambda file: file.endswith('.txt'), os.listdir('.'))):
+            sess, item = read_period_txt(file_name)
+            write_period_bin(file_name[:-len('.txt')], sess, item)
+        print(dataset_name + ' converted!')
+        sys.exit()
+
+    if args.append:
+        # only process new data and write the next period file
+        state = load_state(os.path.join(dataset_name, STATE_FILE))
+        os.chdir('dataset')
+        _, _, reformed_data, _ = read_data(args.append, args.chunk_size, args.workers,
+                                           state['sess_map'], state['item_map'], state['converter'])
+        os.chdir(os.path.join('..', dataset_name))
+        append_period(reformed_data, state, args)
+        save_state(STATE_FILE, state)
+        print(args.append + ' appended as period %d!' % (state['period_num'] - 1))
+        sys.exit()
+
+    # load data and get the session and item lookup table
+    os.chdir('dataset')
+    sess_map, item_map, reformed_data, converter = read_data(args.dataset, args.chunk_size, args.workers)
+
     if not os.path.isdir(os.path.join('..', dataset_name)):
         os.makedirs(os.path.join('..', dataset_name))
     os.chdir(os.path.join('..', dataset_name))
 
     # remove data according to occurrences time
-    removed_data, sess_end = short_remove(reformed_data, args)
+    removed_data, sess_end, item_counter = short_remove(reformed_data, args)
 
     # partition data according to time periods
     time_fraction = time_partition(removed_data, sess_end, args)
 
     # generate final txt file
-    generating_txt(time_fraction, sess_end, args)
+    final_item_map = generating_txt(time_fraction, sess_end, args)
+
+    # save state for appending new data later
+    if args.is_time_fraction:
+        save_state(STATE_FILE, {'sess_map': sess_map, 'item_map': item_map, 'converter': converter,
+                                'item_counter': item_counter, 'sess_end': sess_end,
+                                'final_item_map': final_item_map, 'period_num': len(time_fraction)})
 
     print(args.dataset + ' finish!')
@@ -6,6 +6,10 @@
 import csv
 import tqdm
 import datetime
+import os
+import pickle
+import multiprocessing
+import numpy as np
 
 
 def generate_name_Id_map(name, map):
@@ -23,89 +27,359 @@ def generate_name_Id_map(name, map):
     return Id
 
 
-def generate_sess_end_map(sess_end, sessId, time):
+def generate_sess_end(sessId, time, sess_num):
     """
-    Generate map recording the session end time.
-    :param sess_end: the map recording session end time, a dictionary see_end[sessId]=end_time
-    :param sessId:session Id of new action
-    :param time:time of new action
-    :return: sess_end: the map recording session end time, a dictionary see_end[sessId]=end_time
+    Generate array recording the session end time.
+    :param sessId: session Id of each action
+    :param time: time of each action
+    :param sess_num: size of the returned array, larger than any session Id
+    :return: sess_end: the array recording session end time, sess_end[sessId]=end_time, NaN for absent sessions
     """
-    if sessId in sess_end:
-        sess_end[sessId] = max(time, sess_end[sessId])
-    else:
-        sess_end[sessId] = time
+    order = np.lexsort((time, sessId))
+    sessId, time = sessId[order], time[order]
+    last = np.append(sessId[1:] != sessId[:-1], True)
+    sess_end = np.full(sess_num, np.nan)
+    sess_end[sessId[last]] = time[last]
     return sess_end
 
 
-def read_dat(dataset_path):
+def write_period_txt(file_name, sessId, itemId):
     """
-    Read .dat type dataset file including MovieLens 1M dataset and Yoochoose dataset
+    Write actions of a period in the interchange text format, one 'sessId itemId' line per action.
+    :param file_name: name of text file
+    :param sessId: session Id of each action
+    :param itemId: item Id of each action
+    """
+    with open(file_name, 'w') as f:
+        f.writelines('%d %d\n' % action for action in zip(sessId.tolist(), itemId.tolist()))
+
+
+def group_sessions(sessId, itemId):
+    """
+    Group actions by session in CSR layout, used both for binary period files and for periods parsed by DataLoader.
+    Sessions are ordered by first appearance and items keep their order.
+    :param sessId: session Id of each action
+    :param itemId: item Id of each action
+    :return: items: flat int32 item array, items grouped by session
+    :return: offsets: session offsets, the i-th session is items[offsets[i]:offsets[i + 1]]
+    :return: positions: index of each grouped action in the input, e.g. to order sessions by a later action
+    """
+    _, first_index, inverse = np.unique(sessId, return_index=True, return_inverse=True)
+    rank = np.empty(len(first_index), dtype=np.int64)
+    rank[np.argsort(first_index, kind='stable')] = np.arange(len(first_index))
+    sess_rank = rank[inverse.reshape(-1)]
+    offsets = np.zeros(len(first_index) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sess_rank, minlength=len(first_index)), out=offsets[1:])
+    positions = np.argsort(sess_rank, kind='stable')
+    items = np.asarray(itemId)[positions].astype(np.int32)
+    return items, offsets, positions
+
+
+def write_period_bin(name, sessId, itemId):
+    """
+    Write actions of a period in the binary layout read by DataLoader: items grouped by session in a flat int32
+    array (name.items.npy) and CSR-style session offsets (name.offsets.npy), so that the items of the i-th session
+    are items[offsets[i]:offsets[i + 1]]. Sessions are ordered by first appearance and items keep their order,
+    like the sessions parsed from the text file. The line of each grouped action in the text file is kept in
+    name.positions.npy, offsets are written last.
+    :param name: file name without extension, e.g. 'period_0'
+    :param sessId: session Id of each action
+    :param itemId: item Id of each action
+    """
+    items, offsets, positions = group_sessions(sessId, itemId)
+    np.save(name + '.items.npy', items)
+    np.save(name + '.positions.npy', positions)
+    np.save(name + '.offsets.npy', offsets)
+
+
+def write_period(name, sessId, itemId):
+    """
+    Write actions of a period both in text (name.txt) and binary layout.
+    :param name: file name without extension, e.g. 'period_0'
+    :param sessId: session Id of each action
+    :param itemId: item Id of each action
+    """
+    write_period_txt(name + '.txt', sessId, itemId)
+    write_period_bin(name, sessId, itemId)
+
+
+def read_period_txt(file_name):
+    """
+    Read a period text file written by write_period_txt.
+    :param file_name: name of text file
+    :return: sessId: int64 array, session Id of each action
+    :return: itemId: int64 array, item Id of each action
+    """
+    actions = np.fromfile(file_name, dtype=np.int64, sep=' ').reshape(-1, 2)
+    return actions[:, 0], actions[:, 1]
+
+
+def parallel_starmap(function, jobs, workers):
+    """
+    Run function on each job, in a process pool if more than one worker is used.
+    :param function: function to run, must be defined at module level
+    :param jobs: list of argument tuples
+    :param workers: number of processes
+    :return: list of results, in the order of jobs
+    """
+    if workers > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(min(workers, len(jobs))) as pool:
+            return pool.starmap(function, jobs)
+    return [function(*job) for job in jobs]
+
+
+def shard_file(dataset_path, shard_num, begin=0):
+    """
+    Split a file into byte ranges aligned to line starts.
     :param dataset_path: dataset path
-    :return: sess_map: map[session name in row dataset]=session Id in system
-    :return: item_map: map[item name in row dataset]=item Id in system
-    :return: reformed_data: a list: each element is a action, which is a list of [sessId, itemId, time]
+    :param shard_num: number of shards
+    :param begin: byte offset of the first data row, e.g. after a header line
+    :return: shards: a list of (begin, end) byte ranges covering [begin, file size)
+    """
+    size = os.path.getsize(dataset_path)
+    bounds = [begin]
+    with open(dataset_path, 'rb') as f:
+        for k in range(1, shard_num):
+            f.seek(max(begin + (size - begin) * k // shard_num, bounds[-1]))
+            if f.tell() > begin:
+                # move to the start of the next line
+                f.seek(f.tell() - 1)
+                f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(bounds[k], bounds[k + 1]) for k in range(shard_num) if bounds[k] < bounds[k + 1]]
+
+
+def read_chunks(dataset_path, begin, end, delimiter, chunk_size):
+    """
+    Read the rows of a delimited file inside a byte range in chunks and return each chunk column-wise.
+    :param dataset_path: dataset path
+    :param begin: byte offset of the first row, at a line start
+    :param end: byte offset after the last row, at a line start
+    :param delimiter: column delimiter
+    :param chunk_size: number of rows per chunk
+    :return: generator of chunks, each chunk is a tuple of columns, each column a tuple of strings
+    """
+    with open(dataset_path, 'rb') as f:
+        f.seek(begin)
+        position = begin
+        while position < end:
+            lines = []
+            for line in f:
+                lines.append(line)
+                position += len(line)
+                if position >= end or len(lines) == chunk_size:
+                    break
+            if not lines:
+                break
+            rows = list(csv.reader(b''.join(lines).decode().splitlines(), delimiter=delimiter))
+            yield tuple(zip(*rows))
+
+
+def encode_name_Id(names, map):
+    """
+    Vectorized generate_name_Id_map for a chunk of names. New names get Ids in order of first appearance, so that the
+    result is identical to calling generate_name_Id_map row by row.
+    :param names: a chunk of session or item names in dataset
+    :param map: existing map, a dictionary: map[name]=Id, new names are added in place
+    :return: Ids: int32 array of Ids aligned with names
+    """
+    unique_names, first_index, inverse = np.unique(np.asarray(names), return_index=True, return_inverse=True)
+    unique_names = unique_names.tolist()
+    unique_Ids = np.array([map.get(name, 0) for name in unique_names], dtype=np.int32)
+    # allocate new Ids in order of first appearance inside the chunk
+    new = np.flatnonzero(unique_Ids == 0)
+    new = new[np.argsort(first_index[new], kind='stable')]
+    unique_Ids[new] = np.arange(len(map) + 1, len(map) + 1 + len(new), dtype=np.int32)
+    map.update(zip([unique_names[i] for i in new], unique_Ids[new].tolist()))
+    return unique_Ids[inverse.reshape(-1)]
+
+
+def local_timestamp(datetimes):
+    """
+    Convert naive local datetimes to Unix timestamps, same as int(datetime.datetime.timestamp()) row by row.
+    The local time offset is computed once per distinct hour.
+    :param datetimes: datetime64[s] array of naive local time
+    :return: timestamps: int64 array of Unix timestamps
+    """
+    seconds = datetimes.astype('datetime64[s]').astype(np.int64)
+    hours, inverse = np.unique(datetimes.astype('datetime64[h]'), return_inverse=True)
+    offsets = np.array([int(hour.timestamp()) for hour in hours.astype('datetime64[s]').astype(object)],
+                       dtype=np.int64) - hours.astype('datetime64[s]').astype(np.int64)
+    return seconds + offsets[inverse.reshape(-1)]
+
+
+def merge_name_Id(names, local_Ids, map):
+    """
+    Translate Ids allocated inside one shard into Ids of the global map. Shards are merged in file order, so the
+    result is identical to encoding the whole file at once.
+    :param names: names of the shard, ordered by their shard Id
+    :param local_Ids: Ids allocated by the shard map
+    :param map: global map, a dictionary: map[name]=Id, new names are added in place
+    :return: Ids: int32 array of global Ids aligned with local_Ids
+    """
+    lookup = np.zeros(len(names) + 1, dtype=np.int32)
+    if names:
+        lookup[1:] = encode_name_Id(names, map)
+    return lookup[local_Ids]
+
+
+def read_dat_shard(dataset_path, begin, end, chunk_size, show_progress=True):
+    """
+    Parse one byte range of a .dat type dataset file, allocating session and item Ids local to the shard.
+    :param dataset_path: dataset path
+    :param begin: byte offset of the first row
+    :param end: byte offset after the last row
+    :param chunk_size: number of rows parsed at once
+    :param show_progress: display a progress bar, only for the first shard
+    :return: a tuple (sess_names, sessId, item_names, itemId, time)
     """
     sess_map = {}
     item_map = {}
-    reformed_data = []
+    sess_chunks, item_chunks, time_chunks = [], [], [np.zeros(0, dtype=np.int64)]
+    for columns in tqdm.tqdm(read_chunks(dataset_path, begin, end, ',', chunk_size), desc='Loading data',
+                             unit='chunk', disable=not show_progress):
+        # keep second precision of '%Y-%m-%dT%H:%M:%S.%fZ', timestamp() truncates the fraction anyway
+        time = np.array(columns[1], dtype='U19').astype('datetime64[s]')
+        time_chunks.append(local_timestamp(time))
+        sess_chunks.append(encode_name_Id(columns[0], sess_map))
+        item_chunks.append(encode_name_Id(columns[2], item_map))
+    return list(sess_map), np.concatenate(sess_chunks or [np.zeros(0, dtype=np.int32)]), \
+        list(item_map), np.concatenate(item_chunks or [np.zeros(0, dtype=np.int32)]), np.concatenate(time_chunks)
 
-    dataset_name = dataset_path.split('/')[-1]
-    with open(dataset_path, 'r') as f:
-        """ YOOCHOOSE
-        """
-        for sample in tqdm.tqdm(f, desc='Loading data'):
-            sess = sample.split(',')[0]
-            item = sample.split(',')[2]
-            time = sample.split(',')[1]
-            time = int(datetime.datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%fZ").timestamp())
 
-            sessId = generate_name_Id_map(sess, sess_map)
-            itemId = generate_name_Id_map(item, item_map)
-            reformed_data.append([sessId, itemId, time])
+def read_csv_shard(dataset_path, begin, end, chunk_size, header, show_progress=True):
+    """
+    Parse one byte range of the DIGINETICA .csv file, allocating session and item Ids local to the shard.
+    :param dataset_path: dataset path
+    :param begin: byte offset of the first row
+    :param end: byte offset after the last row
+    :param chunk_size: number of rows parsed at once
+    :param header: list of column names
+    :param show_progress: display a progress bar, only for the first shard
+    :return: a tuple (sess_names, sessId, item_names, itemId, date_names, dateId, timeframe, max_timeframe), where
+             actions without date are removed but still count for max_timeframe
+    """
+    sess_map = {}
+    item_map = {}
+    date_map = {}
+    sess_chunks, item_chunks, date_chunks, timeframe_chunks = [], [], [], []
+    sess_col, item_col = header.index('sessionId'), header.index('itemId')
+    timeframe_col, date_col = header.index('timeframe'), header.index('eventdate')
+    max_timeframe = 0
+    for columns in tqdm.tqdm(read_chunks(dataset_path, begin, end, ';', chunk_size), desc='Loading data',
+                             unit='chunk', disable=not show_progress):
+        timeframe = np.array(columns[timeframe_col]).astype(np.int64)
+        max_timeframe = max(max_timeframe, timeframe.max())
+        date = np.array(columns[date_col])
+        # actions without date are skipped before allocating Ids
+        dated = np.flatnonzero(date != '')
+        sess_chunks.append(encode_name_Id(np.array(columns[sess_col])[dated], sess_map))
+        item_chunks.append(encode_name_Id(np.array(columns[item_col])[dated], item_map))
+        date_chunks.append(encode_name_Id(date[dated], date_map))
+        timeframe_chunks.append(timeframe[dated])
+    empty = [np.zeros(0, dtype=np.int32)]
+    return list(sess_map), np.concatenate(sess_chunks or empty), list(item_map), np.concatenate(item_chunks or empty), \
+        list(date_map), np.concatenate(date_chunks or empty), np.concatenate(timeframe_chunks or empty), max_timeframe
+
+
+def read_dat(dataset_path, chunk_size=1000000, workers=1, sess_map=None, item_map=None):
+    """
+    Read .dat type dataset file including MovieLens 1M dataset and Yoochoose dataset
+    :param dataset_path: dataset path
+    :param chunk_size: number of rows parsed at once
+    :param workers: number of processes parsing byte ranges of the file in parallel
+    :param sess_map: existing session map to extend, e.g. when appending new data, a new map if None
+    :param item_map: existing item map to extend, a new map if None
+    :return: sess_map: map[session name in row dataset]=session Id in system
+    :return: item_map: map[item name in row dataset]=item Id in system
+    :return: reformed_data: a tuple of aligned columns (sessId, itemId, time): int32, int32 and int64 arrays
+    """
+    sess_map = {} if sess_map is None else sess_map
+    item_map = {} if item_map is None else item_map
+
+    """ YOOCHOOSE
+    """
+    jobs = [(dataset_path, begin, end, chunk_size, k == 0)
+            for k, (begin, end) in enumerate(shard_file(dataset_path, workers))]
+    shards = parallel_starmap(read_dat_shard, jobs, workers)
+    # merge shards in file order
+    sess_chunks, item_chunks, time_chunks = [], [], []
+    for sess_names, sessId, item_names, itemId, time in shards:
+        sess_chunks.append(merge_name_Id(sess_names, sessId, sess_map))
+        item_chunks.append(merge_name_Id(item_names, itemId, item_map))
+        time_chunks.append(time)
 
+    reformed_data = (np.concatenate(sess_chunks), np.concatenate(item_chunks), np.concatenate(time_chunks))
     return sess_map, item_map, reformed_data
 
 
-def read_csv(dataset_path):
+def read_csv(dataset_path, chunk_size=1000000, workers=1, sess_map=None, item_map=None, converter=None):
     """
     Read .csv type dataset file including MovieLens 20M dataset and DIGINETICA dataset
     :param dataset_path: dataset path
+    :param chunk_size: number of rows parsed at once
+    :param workers: number of processes parsing byte ranges of the file in parallel
+    :param sess_map: existing session map to extend, e.g. when appending new data, a new map if None
+    :param item_map: existing item map to extend, a new map if None
+    :param converter: seconds per timeframe unit, if None it is derived from the maximum timeframe in the file
     :return: sess_map: map[session name in row dataset]=session Id in system
     :return: item_map: map[item name in row dataset]=item Id in system
-    :return: reformed_data: a list: each element is a action, which is a list of [sessId, itemId, time]
+    :return: reformed_data: a tuple of aligned columns (sessId, itemId, time): int32, int32 and float64 arrays
+    :return: converter: seconds per timeframe unit used to compute time
     """
-    sess_map = {}
-    item_map = {}
-    reformed_data = []
-
-    dataset_name = dataset_path.split('/')[-1]
-    with open(dataset_path) as f:
-
-        if dataset_name.split('-')[0] == 'train':
-            """ DIGINETICA
-            """
-            # with sequence information
-            reader = csv.DictReader(f, delimiter=';')
-            timeframes = []
-            for sample in reader:
-                timeframes.append(int(sample['timeframe']))
-            converter = 86400.00 / max(timeframes)
-            f.seek(0)
-            reader = csv.DictReader(f, delimiter=';')
-            # load data
-            for sample in tqdm.tqdm(reader, desc='Loading data'):
-                sess = sample['sessionId']
-                item = sample['itemId']
-                date = sample['eventdate']
-                timeframe = int(sample['timeframe'])
-                if date:
-                    time = int(datetime.datetime.strptime(date, "%Y-%m-%d").timestamp()) + timeframe * converter
-                else:
-                    continue
-                sessId = generate_name_Id_map(sess, sess_map)
-                itemId = generate_name_Id_map(item, item_map)
-                reformed_data.append([sessId, itemId, time])
-        else:
-            print("Error: new csv data file!")
-    return sess_map, item_map, reformed_data
+    sess_map = {} if sess_map is None else sess_map
+    item_map = {} if item_map is None else item_map
+
+    with open(dataset_path, 'rb') as f:
+        header_line = f.readline()
+    header = next(csv.reader([header_line.decode()], delimiter=';'))
+    if {'sessionId', 'itemId', 'timeframe', 'eventdate'}.issubset(header):
+        """ DIGINETICA
+        """
+        # with sequence information, read in a single pass and convert timeframe once its maximum is known
+        jobs = [(dataset_path, begin, end, chunk_size, header, k == 0)
+                for k, (begin, end) in enumerate(shard_file(dataset_path, workers, len(header_line)))]
+        shards = parallel_starmap(read_csv_shard, jobs, workers)
+        # merge shards in file order
+        date_map = {}
+        sess_chunks, item_chunks, date_chunks, timeframe_chunks = [], [], [], []
+        max_timeframe = 0
+        for sess_names, sessId, item_names, itemId, date_names, dateId, timeframe, shard_max_timeframe in shards:
+            sess_chunks.append(merge_name_Id(sess_names, sessId, sess_map))
+            item_chunks.append(merge_name_Id(item_names, itemId, item_map))
+            date_chunks.append(merge_name_Id(date_names, dateId, date_map))
+            timeframe_chunks.append(timeframe)
+            max_timeframe = max(max_timeframe, shard_max_timeframe)
+
+        if converter is None:
+            converter = 86400.00 / max_timeframe
+        date_time = np.zeros(len(date_map) + 1, dtype=np.int64)
+        for date, dateId in date_map.items():
+            date_time[dateId] = int(datetime.datetime.strptime(date, "%Y-%m-%d").timestamp())
+        time = date_time[np.concatenate(date_chunks)] + np.concatenate(timeframe_chunks) * converter
+        reformed_data = (np.concatenate(sess_chunks), np.concatenate(item_chunks), time)
+    else:
+        print("Error: new csv data file!")
+        reformed_data = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0))
+    return sess_map, item_map, reformed_data, converter
+
+
+def save_state(file_name, state):
+    """
+    Save preprocessing state so that new data can be appended as a new period later.
+    :param file_name: name of state file
+    :param state: a dictionary of maps, counters and session end times, see preprocessing.py
+    """
+    with open(file_name, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_state(file_name):
+    """
+    Load preprocessing state saved by save_state.
+    :param file_name: name of state file
+    :return: state: a dictionary of maps, counters and session end times
+    """
+    with open(file_name, 'rb') as f:
+        return pickle.load(f)
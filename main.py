@@ -14,6 +14,9 @@ from tqdm import tqdm
 from util import *
 import gc
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from checkpoint import WeightSnapshot, Checkpointer
 
 
 def str2bool(v):
@@ -32,6 +35,18 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
+def str2ints(v):
+    """
+    Convert comma separated string to list of integers
+    :param v: string, e.g. '20,10'
+    :return: list of integers
+    """
+    try:
+        return [int(k) for k in v.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Comma separated integers expected.')
+
+
 def get_periods(dataset, logs):
     """
     This function returns list of periods for joint learning or continue learning
@@ -50,19 +65,44 @@ def get_periods(dataset, logs):
     return periods
 
 
+def prepare_period(dataloader, period, joint, joint_store):
+    """
+    This function loads train and test data of a period and expands train sessions into sub-sequences.
+    It does not use random numbers, so it can run in background while the previous period trains. It must be called
+    in period order, test items are filtered by the items loaded so far.
+    :param dataloader: data loader
+    :param period: current period
+    :param joint: if True, train data is accumulated in joint_store
+    :param joint_store: cumulative store of joint learning
+    :return: train sub-sequences, test sessions, maximum item number and data information
+    """
+    infos = []
+    # load train data
+    train_sess, info = dataloader.train_loader(period - 1)
+    infos.append(info)
+    if joint:
+        # joint learning trains on all previous periods, only the newest one is expanded
+        joint_store.extend(train_sess)
+        infos.append(joint_store.info())
+        train_subseq = joint_store.subseq
+    else:
+        train_subseq = expand_sessions(train_sess)
+    # load test data
+    test_sess, info = dataloader.evaluate_loader(period)
+    infos.append(info)
+    max_item = dataloader.max_item()
+    return train_subseq, test_sess, max_item, infos
+
+
 def load_exemplars(fast_exemplar):
     """
     This method load exemplar in previous period
-    :param fast_exemplar: read exemplar directly from previous exemplar variable if None read from .pickle file
-    :return: exemplar list
+    :param fast_exemplar: exemplar store of previous period, or path prefix of the saved store to memory-map
+    :return: exemplar store
     """
-    exemplars = []
-    exemplars_item = fast_exemplar
-
-    for item in exemplars_item.values():
-        if isinstance(item, list):
-            exemplars.extend([i for i in item if i])
-    return exemplars
+    if isinstance(fast_exemplar, ExemplarStore):
+        return fast_exemplar
+    return ExemplarStore.load(fast_exemplar, mmap=True)
 
 
 if __name__ == '__main__':
@@ -78,6 +118,11 @@ if __name__ == '__main__':
     # exemplar
     parser.add_argument('--exemplar_size', default=30000, type=int)  # size of exemplars
     parser.add_argument('--lambda_', default=0.8, type=float)  # base adaptive weight
+    parser.add_argument('--exemplar_dtype', default='float16', type=str)  # ['float32', 'float16', 'int8'] of logits
+    parser.add_argument('--exemplar_mmap', default=False, type=str2bool)  # keep exemplar logits memory-mapped on disk
+    parser.add_argument('--distill_topk', default=0, type=int)  # distill on top-K logits of exemplars, 0 for all items
+    parser.add_argument('--distill_mode', default='stored', type=str)  # ['stored', 'teacher'] source of exemplar logits
+    parser.add_argument('--exemplar_device', default=False, type=str2bool)  # keep exemplars in model variables
     # baseline
     parser.add_argument('--finetune', default=False, type=bool)  # use fine tuned hyper-parameter without dropout
     parser.add_argument('--dropout', default=False, type=bool)  # use dropout
@@ -93,7 +138,23 @@ if __name__ == '__main__':
     parser.add_argument('--num_epochs', default=100, type=int)
     parser.add_argument('--batch_size', default=256, type=int)
     parser.add_argument('--test_batch', default=64, type=int)
+    parser.add_argument('--score_batch', default=1024, type=int)  # sequences scored per matmul, 0 to rank in graph
+    parser.add_argument('--cutoffs', default='20,10', type=str2ints)  # K of metrics @K, validation uses the first one
+    parser.add_argument('--train_softmax', default='full', type=str)  # ['full', 'sampled', 'inbatch'] training loss
+    parser.add_argument('--num_sampled', default=1000, type=int)  # number of negative items of sampled softmax
     parser.add_argument('--device_num', default=0, type=int)
+    parser.add_argument('--keep_session', default=True, type=str2bool)  # one session for all periods, weights in memory
+    parser.add_argument('--save_checkpoints', default=True, type=str2bool)  # write best epoch checkpoints to disk
+    parser.add_argument('--async_checkpoints', default=True, type=str2bool)  # write checkpoints in background
+    parser.add_argument('--slim_checkpoints', default=False, type=str2bool)  # save model weights only for inference
+    parser.add_argument('--checkpoint_keep', default=1, type=int)  # number of checkpoints kept in each period
+    # data loading
+    parser.add_argument('--cache_size', default=4, type=int)  # number of parsed periods kept in memory
+    parser.add_argument('--disk_cache', default=True, type=str2bool)  # keep parsed text periods in data/cache
+    parser.add_argument('--prefetch', default=True, type=str2bool)  # load next period while current period trains
+    parser.add_argument('--prefetch_batches', default=8, type=int)  # number of batches prepared ahead, 0 to disable
+    parser.add_argument('--bucket_batches', default=0, type=int)  # batches per length-sorted pool, 0 to disable
+    parser.add_argument('--dedup', default=False, type=str2bool)  # collapse duplicate train examples into weights
     # hyper-parameters grid search
     parser.add_argument('--lr', default=0.0005, type=float)
     parser.add_argument('--num_blocks', default=2, type=int)
@@ -139,19 +200,50 @@ if __name__ == '__main__':
     # Disable dropout for EWC and fine-tune baseline
     args.dropout_rate = 0 if (args.ewc or args.finetune) else args.dropout_rate
 
+    if min(args.cutoffs) < 1:
+        raise ValueError('Invalid metric cutoffs')
+    if args.distill_mode not in ('stored', 'teacher'):
+        raise ValueError('Invalid distillation mode')
+    if args.train_softmax not in ('full', 'sampled', 'inbatch'):
+        raise ValueError('Invalid training softmax')
+    if not (args.keep_session or args.save_checkpoints):
+        raise ValueError('Checkpoints are needed to restore weights without a long-lived session')
+    if args.slim_checkpoints and not args.keep_session:
+        raise ValueError('Slim checkpoints without optimizer state cannot restore training between periods')
+    # teacher mode recomputes exemplar logits with a frozen copy of the previous model instead of storing them
+    use_teacher = args.distill_mode == 'teacher' and not (args.ewc or args.disable_distillation)
+    use_device_exemplar = args.exemplar_device and not args.ewc
     with tf.device('/gpu:%d' % args.device_num):
         model = Ader(item_num, args) if not args.ewc else Ewc(item_num, args)
+    saver = tf.train.Saver(max_to_keep=1)
+    snapshot = WeightSnapshot(tf.global_variables())
+    if args.save_checkpoints:
+        if args.slim_checkpoints:
+            # model weights without optimizer slots, global step and teacher
+            checkpoint_variables = [v for v in tf.trainable_variables() if not v.name.startswith('Teacher/')]
+        else:
+            checkpoint_variables = tf.global_variables()
+        checkpointer = Checkpointer(checkpoint_variables, args.checkpoint_keep, args.async_checkpoints)
+    else:
+        checkpointer = None
+    global_init = tf.global_variables_initializer()
+    local_init = tf.local_variables_initializer()
+    # periods reuse the same graph, no operation is added after this point
+    tf.get_default_graph().finalize()
+    # with a long-lived session, best weights are handed to the next period in memory
+    shared_sess = tf.Session(config=config) if args.keep_session else None
 
     # Loop each period for continue learning
     periods = get_periods(args.dataset, logs)
-    dataloader = DataLoader(args.dataset)
+    cache_dir = os.path.join('..', '..', 'data', 'cache') if args.disk_cache else None
+    dataloader = DataLoader(args.dataset, args.cache_size, cache_dir)
     best_epoch, item_num_prev = 0, 0
+    joint_store = CumulativeStore()
+    prefetcher = ThreadPoolExecutor(max_workers=1) if args.prefetch else None
+    next_period_data = None
     t_start = time.time()
 
-    MRR_20 = []
-    Recall_20 = []
-    MRR_10 = []
-    Recall_10 = []
+    test_results = []
     for period in periods:
 
         print('Period %d:' % period)
@@ -159,94 +251,136 @@ if __name__ == '__main__':
         best_performance, performance = 0, 0
 
         # Prepare data
-        # load train data
-        train_sess, info = dataloader.train_loader(period - 1)
-        logs.write(info + '\n')
-        if args.joint and period > 1:
-            for p in range(1, period):
-                pre_train_sess, info = dataloader.train_loader(p-1)
-                logs.write(info + '\n')
-                train_sess.extend(pre_train_sess)
-        train_sampler = Sampler(train_sess, args.maxlen, args.batch_size)
+        if next_period_data is None:
+            period_data = prepare_period(dataloader, period, args.joint, joint_store)
+        else:
+            period_data = next_period_data.result()
+        train_subseq, test_sess, max_item, infos = period_data
+        for info in infos:
+            logs.write(info + '\n')
+        # load next period in background while this period trains
+        if prefetcher is not None and period + 1 in periods:
+            next_period_data = prefetcher.submit(prepare_period, dataloader, period + 1, args.joint, joint_store)
+        else:
+            next_period_data = None
+        train_sampler = Sampler(train_subseq, args.maxlen, args.batch_size, is_subseq=True,
+                                bucket_batches=args.bucket_batches)
         valid_subseq, train_subseq = train_sampler.split_data(valid_portion=0.1, return_train=True)
+        train_size = train_sampler.data_size()
+        if args.dedup:
+            train_sampler.deduplicate()
+            logs.write('Distinct training examples: %d of %d\n' % (train_sampler.data_size(), train_size))
         batch_num = train_sampler.batch_num()
-        # load test data
-        test_sess, info = dataloader.evaluate_loader(period)
-        logs.write(info + '\n')
-        max_item = dataloader.max_item()
         # exemplar
         if period > 1 and not(args.finetune or args.dropout or args.joint):
-            exemplar_data_logits = load_exemplars(fast_exemplar)
-            exemplar_size = len(exemplar_data_logits)
-            exemplar_subseq = np.array(exemplar_data_logits)[:, 0].tolist()
+            exemplar_store = load_exemplars(fast_exemplar)
+            exemplar_size = len(exemplar_store)
+            exemplar_subseq = list(exemplar_store.sessions())
             # prepare exemplar sampler
             batch_num = train_sampler.batch_num()
             exemplar_batch = int(exemplar_size / batch_num)
-            exemplar_sampler = Sampler([], args.maxlen, exemplar_batch)
-            exemplar_sampler.add_exemplar(exemplar_data_logits)
+            exemplar_sampler = Sampler([], args.maxlen, exemplar_batch, bucket_batches=args.bucket_batches)
+            exemplar_sampler.add_exemplar(exemplar_store)
         else:
             exemplar_subseq = []
 
-        # Set loss
+        # Set loss weight of exemplars or EWC penalty, the train op is built once with the model
         if period > 1 and not (args.finetune or args.dropout or args.joint):
             # find lambda for current cycle
             if args.ewc or args.fix_lambda:
                 lambda_ = args.lambda_
             else:
-                train_size = train_sampler.data_size()
                 lambda_ = args.lambda_ * math.sqrt((item_num_prev / max_item) * (exemplar_size / train_size))
-            model.update_loss(lambda_=lambda_)
         else:
-            model.set_vanilla_loss()
+            lambda_ = 0.0
 
         # Start of the main algorithm
-        with tf.Session(config=config) as sess:
+        with nullcontext(shared_sess) if args.keep_session else tf.Session(config=config) as sess:
 
             # initialize variables or reload from previous period
-            saver = tf.train.Saver(max_to_keep=1)
+            if checkpointer is not None:
+                checkpointer.new_period()
             if period > 1 and not args.joint:
-                saver.restore(sess, 'model/period%d/epoch=%d.ckpt' % (period - 1, best_epoch))
+                # a long-lived session still holds the weights of the best epoch of previous period
+                if not args.keep_session:
+                    saver.restore(sess, 'model/period%d/epoch=%d.ckpt' % (period - 1, best_epoch))
+                if use_teacher:
+                    # freeze previous period model as teacher of exemplar logits
+                    sess.run(model.update_teacher)
             else:
-                sess.run(tf.global_variables_initializer())
-
-            # train
+                sess.run(global_init)
+            sess.run(local_init)
+            if period > 1 and args.ewc:
+                model.load_penalty(sess)
+
+            # train, batches are prepared in background
+            if period > 1 and not (args.finetune or args.dropout or args.joint or args.ewc):
+                if use_device_exemplar:
+                    # exemplars are copied into the model once, training steps only feed their indices
+                    exemplar_seq, exemplar_pos = exemplar_sampler.exemplar_inputs()
+                    model.load_exemplars(sess, exemplar_seq, exemplar_pos, exemplar_store)
+                train_batches = BatchPrefetcher(train_sampler, exemplar_sampler, args.prefetch_batches,
+                                                exemplar_index=use_device_exemplar)
+            else:
+                train_batches = BatchPrefetcher(train_sampler, None, args.prefetch_batches)
             best_epoch = 1
             for epoch in range(1, args.num_epochs + 1):
 
                 # train each epoch
-                for _ in tqdm(range(batch_num), total=batch_num, ncols=70, leave=False, unit='b',
-                              desc='Training epoch %d/%d' % (epoch, args.num_epochs)):
-                    # load train batch
-                    seq, pos = train_sampler.sampler()
-
+                for seq, pos, weight, ex_pos, targets in tqdm(train_batches.epoch(batch_num), total=batch_num,
+                                                              ncols=70, leave=False, unit='b',
+                                                              desc='Training epoch %d/%d' % (epoch, args.num_epochs)):
                     if period > 1 and not (args.finetune or args.dropout or args.joint or args.ewc):
-                        ex_seq, ex_pos, logits = exemplar_sampler.exemplar_sampler()
-                        seq = seq + ex_seq
-
-                        if args.disable_distillation:
-                            # exemplar using one-hot label
+                        if use_device_exemplar:
+                            # exemplar inputs and targets are gathered in the model
                             sess.run(model.train_op, {model.input_seq: seq,
                                                       model.pos: pos,
+                                                      model.weight: weight,
                                                       model.is_training: True,
                                                       model.max_item: max_item,
-                                                      model.exemplar_pos: ex_pos,
+                                                      model.lambda_: lambda_,
+                                                      model.exemplar_batch: ex_pos,
+                                                      model.max_item_pre: item_num_prev,
                                                       model.dropout_rate: args.dropout_rate,
                                                       model.lr: args.lr})
-                        else:
-                            # exemplar using logistic-matching label, knowledge distillation
+                        elif args.disable_distillation or use_teacher:
+                            # exemplar using one-hot label, or logits of teacher computed in the same step
                             sess.run(model.train_op, {model.input_seq: seq,
                                                       model.pos: pos,
+                                                      model.weight: weight,
                                                       model.is_training: True,
                                                       model.max_item: max_item,
-                                                      model.exemplar_logits: logits,
+                                                      model.lambda_: lambda_,
+                                                      model.exemplar_pos: ex_pos,
+                                                      model.max_item_pre: item_num_prev,
                                                       model.dropout_rate: args.dropout_rate,
                                                       model.lr: args.lr})
+                        else:
+                            # exemplar using logistic-matching label, knowledge distillation
+                            logits, indices, tail = targets
+                            feed_dict = {model.input_seq: seq,
+                                         model.pos: pos,
+                                         model.weight: weight,
+                                         model.is_training: True,
+                                         model.max_item: max_item,
+                                         model.lambda_: lambda_,
+                                         model.exemplar_logits: logits,
+                                         model.dropout_rate: args.dropout_rate,
+                                         model.lr: args.lr}
+                            if indices is not None:
+                                # top-K logits of previous model
+                                feed_dict.update({model.exemplar_index: indices,
+                                                  model.exemplar_tail: tail,
+                                                  model.max_item_pre: item_num_prev})
+                            sess.run(model.train_op, feed_dict)
                     else:
                         # without using exemplar for initial cycle and baselines
                         sess.run(model.train_op, {model.input_seq: seq,
                                                   model.pos: pos,
+                                                  model.weight: weight,
                                                   model.is_training: True,
                                                   model.max_item: max_item,
+                                                  model.lambda_: lambda_,
                                                   model.dropout_rate: args.dropout_rate,
                                                   model.lr: args.lr})
 
@@ -258,9 +392,9 @@ if __name__ == '__main__':
 
                 # validate performance
                 valid_evaluator = Evaluator(valid_subseq, True, args.maxlen, args.test_batch,
-                                            max_item, 'valid', model, sess, logs)
+                                            max_item, 'valid', model, sess, logs, args.cutoffs, args.score_batch)
                 valid_evaluator.evaluate(epoch)
-                performance = valid_evaluator.results()[1]
+                performance = valid_evaluator.results()['RECALL@%d' % args.cutoffs[0]]
 
                 # early stop
                 if best_performance >= performance:
@@ -271,26 +405,30 @@ if __name__ == '__main__':
                     stop_counter = 0
                     best_epoch = epoch
                     best_performance = performance
-                    saver.save(sess, 'model/period%d/epoch=%d.ckpt' % (period, epoch))
+                    if args.keep_session:
+                        snapshot.save(sess)
+                    if checkpointer is not None:
+                        checkpointer.save(sess, 'model/period%d/epoch=%d.ckpt' % (period, epoch))
 
             # test performance
-            saver.restore(sess, 'model/period%d/epoch=%d.ckpt' % (period, best_epoch))
+            if args.keep_session:
+                snapshot.restore(sess)
+            else:
+                checkpointer.wait()
+                saver.restore(sess, 'model/period%d/epoch=%d.ckpt' % (period, best_epoch))
             test_evaluator = Evaluator(test_sess, False, args.maxlen, args.test_batch,
-                                       max_item, 'test', model, sess, logs)
+                                       max_item, 'test', model, sess, logs, args.cutoffs, args.score_batch)
             test_evaluator.evaluate(best_epoch)
-            MRR_20.append(test_evaluator.results()[0])
-            Recall_20.append(test_evaluator.results()[1])
-            MRR_10.append(test_evaluator.results()[2])
-            Recall_10.append(test_evaluator.results()[3])
+            test_results.append(test_evaluator.results())
 
             # save exemplars
             if not (args.dropout or args.finetune or args.joint):
-                exemplar_candidate = train_subseq
-                exemplar_candidate.extend(valid_subseq)
-                exemplar_candidate.extend(exemplar_subseq)
+                exemplar_candidate = SubseqData.concat([train_subseq, valid_subseq,
+                                                        SubseqData.from_sessions(exemplar_subseq)])
                 exemplar = ExemplarGenerator(exemplar_candidate,
                                              args.exemplar_size, args.equal_exemplar, args.batch_size, args.maxlen,
-                                             args.dropout_rate, max_item, logs)
+                                             args.dropout_rate, max_item, logs, args.distill_topk,
+                                             args.exemplar_dtype, keep_logits=not use_teacher)
                 if args.selection == 'herding':
                     exemplar.herding_selection(sess, model)
                 elif args.selection == 'loss':
@@ -299,25 +437,39 @@ if __name__ == '__main__':
                     exemplar.randomly_selection(sess, model)
                 else:
                     print("Invalid exemplar selection method")
-                fast_exemplar = exemplar.exemplars
+                fast_exemplar = exemplar.to_store()
                 del exemplar
+                if fast_exemplar.tail is not None and len(fast_exemplar):
+                    info = 'Mean probability outside top-%d exemplar logits: %.4f' % (args.distill_topk,
+                                                                                     fast_exemplar.tail.mean())
+                    print(info)
+                    logs.write(info + '\n')
+                if args.exemplar_mmap:
+                    # keep exemplar logits on disk until the next period samples them
+                    if not os.path.isdir('exemplar'):
+                        os.makedirs('exemplar')
+                    fast_exemplar.save(os.path.join('exemplar', 'period%d' % period))
+                    fast_exemplar = os.path.join('exemplar', 'period%d' % period)
 
             # save current meta-data for next cycle
             item_num_prev = max_item
 
             # if use ewc method, calculate fisher and save variable for the next sample
             if args.ewc:
-                exemplar_subseq = np.array(load_exemplars(fast_exemplar))[:, 0].tolist()
+                exemplar_subseq = list(load_exemplars(fast_exemplar).sessions())
                 model.variables_prev = sess.run(model.variables)
                 random_exemplar = random.sample(exemplar_subseq, min(len(exemplar_subseq), args.ewc_sample_num))
                 model.compute_fisher(sess, random_exemplar, 50, max_item)
 
-    MRR_20, Recall_20, MRR_10, Recall_10 = np.array(MRR_20).mean(), \
-                                           np.array(Recall_20).mean(), \
-                                           np.array(MRR_10).mean(), \
-                                           np.array(Recall_10).mean()
-    info = 'Average: (MRR@20: %.4f, RECALL@20: %.4f, MRR@10: %.4f, RECALL@10: %.4f)' % (MRR_20, Recall_20,
-                                                                                        MRR_10, Recall_10)
+    if prefetcher is not None:
+        prefetcher.shutdown()
+    if checkpointer is not None:
+        checkpointer.wait()
+    if shared_sess is not None:
+        shared_sess.close()
+
+    info = 'Average: (%s)' % ', '.join('%s: %.4f' % (name, np.mean([results[name] for results in test_results]))
+                                       for name in test_results[0])
     print(info)
     logs.write(info + '\n')
     print('Total time: %.2f minutes.' % ((time.time() - t_start) / 60.0))
@@ -194,7 +194,7 @@ def multihead_attention(queries,
   
         # Causality = Future blinding
         if causality:
-            diag_vals = tf.ones_like(outputs[0, :, :]) # (T_q, T_k)
+            diag_vals = tf.ones(tf.shape(outputs)[1:], dtype=outputs.dtype) # (T_q, T_k), also for empty batches
             tril = tf.linalg.LinearOperatorLowerTriangular(diag_vals).to_dense() # (T_q, T_k)
             masks = tf.tile(tf.expand_dims(tril, 0), [tf.shape(outputs)[0], 1, 1]) # (h*N, T_q, T_k)
    
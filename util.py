@@ -7,26 +7,102 @@
 from typing import Any, Callable, List, Optional, Union, Tuple, TextIO, Set
 import random
 import os
+import queue
+import threading
 import numpy as np
 import math
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from tqdm import tqdm
+from data.util import group_sessions
 
 
 class DataLoader:
     """ DataLoader object to load train, valid and test data from dataset.
     Args:
         dataset (str): Name of the dataset.
+        cache_size (int): Number of parsed periods kept in memory.
+        cache_dir (str): Directory keeping parsed text periods across runs, None to disable.
     """
 
     def __init__(self,
                  dataset: str,
+                 cache_size: int = 4,
+                 cache_dir: Optional[str] = None
                  ) -> None:
 
-        self.item_set = set()
+        # item_set[itemId] is True if the item appeared in loaded training data
+        self.item_set = np.zeros(0, dtype=bool)
+        self.item_max = 0
         self.path = os.path.join('..', '..', 'data', dataset)
         # remove item in testing data that not appeared in training data
         self.is_remove_item = True
+        # read binary period files written by preprocessing when they exist
+        self.use_binary = True
+        # parsed periods: least recently used periods are dropped from memory first
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+
+    def has_binary(self,
+                   period: int
+                   ) -> bool:
+        """ This method checks whether the binary files of specific period exist.
+        Args:
+            period (int): The period to check.
+        Returns:
+            (bool): True if items, positions and offsets files exist.
+        """
+        name = os.path.join(self.path, 'period_%d' % period)
+        return self.use_binary and all(os.path.isfile(name + suffix)
+                                       for suffix in ('.items.npy', '.positions.npy', '.offsets.npy'))
+
+    def period_loader(self,
+                      period: int
+                      ) -> (np.ndarray, np.ndarray, np.ndarray):
+        """ This method returns the parsed sessions of specific period. Binary period files are memory-mapped,
+        text files are parsed once and kept in the in-memory cache and in cache_dir.
+        Args:
+            period (int): The period which load data from.
+        Returns:
+            items (np.ndarray): Flat int32 item array, items grouped by session.
+            offsets (np.ndarray): Session offsets, the i-th session is items[offsets[i]:offsets[i + 1]].
+            positions (np.ndarray): Line of each grouped action in the period text file.
+        """
+        name = os.path.join(self.path, 'period_%d' % period)
+        is_binary = self.has_binary(period)
+        source = name + ('.items.npy' if is_binary else '.txt')
+        key = (os.path.abspath(source), os.stat(source).st_mtime_ns)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        if is_binary:
+            name_parsed = name
+        elif self.cache_dir is not None:
+            name_parsed = os.path.join(self.cache_dir, '%s_period_%d_%d' % (os.path.basename(self.path), period, key[1]))
+        else:
+            name_parsed = None
+        if name_parsed is not None and os.path.isfile(name_parsed + '.offsets.npy') \
+                and os.path.isfile(name_parsed + '.positions.npy'):
+            # plain ndarray views of the mapped files, memmap views are slow to slice
+            items = np.asarray(np.load(name_parsed + '.items.npy', mmap_mode='r'))
+            positions = np.asarray(np.load(name_parsed + '.positions.npy', mmap_mode='r'))
+            offsets = np.asarray(np.load(name_parsed + '.offsets.npy', mmap_mode='r'))
+        else:
+            actions = np.fromfile(source, dtype=np.int64, sep=' ').reshape(-1, 2)
+            items, offsets, positions = group_sessions(actions[:, 0], actions[:, 1])
+            if name_parsed is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # offsets are written last, they mark a complete entry
+                np.save(name_parsed + '.items.npy', items)
+                np.save(name_parsed + '.positions.npy', positions)
+                np.save(name_parsed + '.offsets.tmp.npy', offsets)
+                os.replace(name_parsed + '.offsets.tmp.npy', name_parsed + '.offsets.npy')
+
+        self.cache[key] = (items, offsets, positions)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return items, offsets, positions
 
     def train_loader(self,
                      period: int
@@ -38,20 +114,11 @@ class DataLoader:
             sessions (list): Training item sequences (session) of selected periods.
             info (str): Information of training data.
         """
-        Sessions = defaultdict(list)
-        file_name = '/period_%d.txt' % period
-        with open(self.path + file_name, 'r') as f:
-            for line in f:
-                sessId, itemId = line.rstrip().split(' ')
-                sessId = int(sessId)
-                itemId = int(itemId)
-                self.item_set.add(itemId)
-                Sessions[sessId].append(itemId)
-
-        sessions = list(Sessions.values())
-        del Sessions
-        info = 'Train set information: total number of action: %d.' \
-               % sum(list(map(lambda session: len(session), sessions)))
+        items, offsets, _ = self.period_loader(period)
+        self.add_items(items)
+        # sessions are views of the cached item array
+        sessions = np.split(items, offsets[1:-1]) if len(items) else []
+        info = 'Train set information: total number of action: %d.' % len(items)
         print(info)
 
         return sessions, info
@@ -66,134 +133,375 @@ class DataLoader:
             sessions (list): Testing item sequences (session) of selected periods.
             info (str): Information of testing data.
         """
-        Sessions = defaultdict(list)
+        items, offsets, positions = self.period_loader(period)
+        total_num = len(items)
         removed_num = 0
-        total_num = 0
-        file_name = '/period_%d.txt' % period
-        with open(self.path + file_name, 'r') as f:
-            for line in f:
-                total_num += 1
-                sessId, itemId = line.rstrip().split(' ')
-                sessId = int(sessId)
-                itemId = int(itemId)
-                # remove new items in test or validation set that not appear in train set
-                if self.is_remove_item and (itemId not in self.item_set):
-                    removed_num += 1
-                    continue
-                else:
-                    self.item_set.add(itemId)
-                Sessions[sessId].append(itemId)
-
-        if self.is_remove_item:
-            delete_keys = []
-            for sessId in Sessions:
-                if len(Sessions[sessId]) == 1:
-                    removed_num += 1
-                    delete_keys.append(sessId)
-            for delete_key in delete_keys:
-                del Sessions[delete_key]
+        if self.is_remove_item and total_num:
+            # remove new items in test or validation set that not appear in train set,
+            # then sessions left with a single item
+            session_idx = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            is_kept = self.has_items(items)
+            length = np.bincount(session_idx[is_kept], minlength=len(offsets) - 1)
+            removed_num = total_num - np.count_nonzero(is_kept) + np.count_nonzero(length == 1)
+            is_kept &= (length > 1)[session_idx]
+            length = length[length > 1]
+            items = items[is_kept]
+            positions = positions[is_kept]
+            offsets = np.concatenate(([0], np.cumsum(length)))
+        elif not self.is_remove_item:
+            self.add_items(items)
+        sessions = np.split(items, offsets[1:-1]) if len(items) else []
+        if len(items):
+            # sessions are ordered by their first kept action, as when test data was read line by line
+            order = np.argsort(positions[offsets[:-1]], kind='stable')
+            sessions = [sessions[i] for i in order]
 
         info = 'Test set information: original total number of action: %d, removed number of action: %d.' \
                % (total_num, removed_num)
-        sessions = list(Sessions.values())
-        del Sessions
 
         return sessions, info
 
+    def add_items(self,
+                  items: np.ndarray
+                  ) -> None:
+        """ This method marks items as seen and updates the maximum item number.
+        Args:
+            items (np.ndarray): Item Ids.
+        """
+        if len(items) == 0:
+            return
+        self.item_max = max(self.item_max, int(items.max()))
+        if self.item_max >= len(self.item_set):
+            # grow geometrically so that appending periods with new items stays cheap
+            item_set = np.zeros(max(self.item_max + 1, 2 * len(self.item_set)), dtype=bool)
+            item_set[:len(self.item_set)] = self.item_set
+            self.item_set = item_set
+        self.item_set[items] = True
+
+    def has_items(self,
+                  items: np.ndarray
+                  ) -> np.ndarray:
+        """ This method checks which items have been seen.
+        Args:
+            items (np.ndarray): Item Ids.
+        Returns:
+            (np.ndarray): Boolean array, True for items seen in training data.
+        """
+        is_known = items < len(self.item_set)
+        is_known[is_known] = self.item_set[items[is_known]]
+        return is_known
+
     def max_item(self) -> int:
         """ This method returns the maximum item number in current cycle training data.
         """
-        return max(self.item_set)
+        return self.item_max
+
+
+class SubseqData:
+    """ Sub-sequences stored as (session index, end offset) pairs into one flat int32 item array, the i-th
+    sub-sequence is items[offsets[sess_idx[i]]:ends[i]]. Prefixes of a session share its items, so memory is linear
+    in the number of actions.
+    Args:
+        items (np.ndarray): Flat int32 item array, items grouped by session.
+        offsets (np.ndarray): Session offsets, the j-th session is items[offsets[j]:offsets[j + 1]].
+        sess_idx (np.ndarray): Session index of each sub-sequence.
+        ends (np.ndarray): End offset of each sub-sequence in items.
+    """
+
+    def __init__(self,
+                 items: np.ndarray,
+                 offsets: np.ndarray,
+                 sess_idx: np.ndarray,
+                 ends: np.ndarray
+                 ) -> None:
+
+        self.items = items
+        self.offsets = offsets
+        self.sess_idx = sess_idx
+        self.ends = ends
+
+    @classmethod
+    def from_sessions(cls,
+                      sessions: list
+                      ) -> 'SubseqData':
+        """ Build sub-sequences from item sequences, each sequence is one sub-sequence.
+        Args:
+            sessions (list): Item sequences.
+        Returns:
+            (SubseqData): One sub-sequence per sequence.
+        """
+        lengths = np.fromiter(map(len, sessions), dtype=np.int64, count=len(sessions))
+        offsets = np.zeros(len(sessions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        items = np.concatenate(sessions).astype(np.int32) if offsets[-1] else np.zeros(0, dtype=np.int32)
+        return cls(items, offsets, np.arange(len(sessions)), offsets[1:].copy())
+
+    @staticmethod
+    def concat(parts: list
+               ) -> 'SubseqData':
+        """ Concatenate sub-sequences, parts sharing the same item array (e.g. from take) share it in the result.
+        Args:
+            parts (list): SubseqData objects.
+        Returns:
+            (SubseqData): All sub-sequences in order of parts.
+        """
+        items, offsets, sess_idx, ends = [np.zeros(0, dtype=np.int32)], [], [], []
+        shifts = {}
+        item_shift, sess_shift = 0, 0
+        for part in parts:
+            if id(part.items) not in shifts:
+                shifts[id(part.items)] = (item_shift, sess_shift)
+                items.append(part.items)
+                offsets.append(part.offsets[:-1] + item_shift)
+                item_shift += len(part.items)
+                sess_shift += len(part.offsets) - 1
+            part_item_shift, part_sess_shift = shifts[id(part.items)]
+            sess_idx.append(part.sess_idx + part_sess_shift)
+            ends.append(part.ends + part_item_shift)
+        offsets.append(np.array([item_shift], dtype=np.int64))
+        return SubseqData(np.concatenate(items), np.concatenate(offsets),
+                          np.concatenate(sess_idx or [np.zeros(0, dtype=np.int64)]),
+                          np.concatenate(ends or [np.zeros(0, dtype=np.int64)]))
+
+    def take(self,
+             indices: np.ndarray
+             ) -> 'SubseqData':
+        """ Select sub-sequences without copying items.
+        Args:
+            indices (np.ndarray): Indices of selected sub-sequences.
+        Returns:
+            (SubseqData): Selected sub-sequences.
+        """
+        return SubseqData(self.items, self.offsets, self.sess_idx[indices], self.ends[indices])
+
+    def lengths(self) -> np.ndarray:
+        """ Length of each sub-sequence.
+        """
+        return self.ends - self.offsets[self.sess_idx]
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    def __getitem__(self,
+                    index: int
+                    ) -> np.ndarray:
+        return self.items[self.offsets[self.sess_idx[index]]:self.ends[index]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def expand_sessions(sessions: list
+                    ) -> SubseqData:
+    """ Expand sessions into sub-sequences: each session and all its prefixes of length at least 2.
+    Args:
+        sessions (list): Original item sequences (session).
+    Returns:
+        subseq (SubseqData): Sub-sequences, the prefixes of each session follow the session from longest to shortest.
+    """
+    data = SubseqData.from_sessions(sessions)
+    lengths = np.diff(data.offsets)
+    subseq_num = np.where(lengths > 2, lengths - 1, 1)
+    sess_idx = np.repeat(np.arange(len(lengths)), subseq_num)
+    first = np.repeat(np.cumsum(subseq_num) - subseq_num, subseq_num)
+    ends = data.offsets[sess_idx + 1] - (np.arange(len(sess_idx)) - first)
+    return SubseqData(data.items, data.offsets, sess_idx, ends)
+
+
+class CumulativeStore:
+    """ This object keeps the growing training data of joint learning. Sessions of each new period are expanded
+    into sub-sequences once and appended, instead of reloading and expanding all previous periods. Arrays are kept
+    in buffers whose capacity doubles, so appending a period only copies its own data, and subseq views the filled
+    part of the buffers.
+    """
+
+    def __init__(self) -> None:
+
+        self.items = np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.sess_idx = np.zeros(0, dtype=np.int64)
+        self.ends = np.zeros(0, dtype=np.int64)
+        self.item_num, self.sess_num, self.subseq_num = 0, 0, 0
+        self.subseq = SubseqData(self.items, self.offsets, self.sess_idx, self.ends)
+        self.action_num = 0
+
+    @staticmethod
+    def append(buffer: np.ndarray,
+               size: int,
+               values: np.ndarray
+               ) -> np.ndarray:
+        """ Write values after the first size elements of a buffer, the buffer is replaced by one of twice the
+        capacity when it is full. Views of the filled part of a replaced buffer stay valid.
+        Args:
+            buffer (np.ndarray): Buffer array.
+            size (int): Number of filled elements.
+            values (np.ndarray): Values to append.
+        Returns:
+            (np.ndarray): Buffer holding the appended values.
+        """
+        if size + len(values) > len(buffer):
+            grown = np.empty(max(size + len(values), 2 * len(buffer)), dtype=buffer.dtype)
+            grown[:size] = buffer[:size]
+            buffer = grown
+        buffer[size:size + len(values)] = values
+        return buffer
+
+    def extend(self,
+               sessions: list
+               ) -> None:
+        """ Append sessions of a new period.
+        Args:
+            sessions (list): Training item sequences (session) of the new period.
+        """
+        part = expand_sessions(sessions)
+        self.items = self.append(self.items, self.item_num, part.items)
+        self.offsets = self.append(self.offsets, self.sess_num + 1, part.offsets[1:] + self.item_num)
+        self.sess_idx = self.append(self.sess_idx, self.subseq_num, part.sess_idx + self.sess_num)
+        self.ends = self.append(self.ends, self.subseq_num, part.ends + self.item_num)
+        self.item_num += len(part.items)
+        self.sess_num += len(part.offsets) - 1
+        self.subseq_num += len(part)
+        self.subseq = SubseqData(self.items[:self.item_num], self.offsets[:self.sess_num + 1],
+                                 self.sess_idx[:self.subseq_num], self.ends[:self.subseq_num])
+        self.action_num += sum(map(len, sessions))
+
+    def info(self) -> str:
+        """ Information of the accumulated training data.
+        """
+        return 'Joint train set information: total number of action: %d, number of sub-sequence: %d.' \
+               % (self.action_num, len(self.subseq))
 
 
 class Sampler:
     """ This object samples data and generates positive labels for train, valid and test data,
             as well as negative sample for training data.
     Args:
-        data (list): Original data needs to be sampled.
+        data (list): Original data needs to be sampled, a list of sessions or sub-sequences, or SubseqData.
         maxlen (int): The length of each sequence.
         batch_size (int): The number of data in one batch.
         is_subseq (bool): If True, the given data is sub-sequence. If False, the given data is full
             original data.
+        bucket_batches (int): If positive, sub-sequences are sorted by length inside pools of bucket_batches
+            batches and each batch is trimmed to its longest sequence. 0 keeps random batches of length maxlen.
     """
 
     def __init__(self,
                  data: list,
                  maxlen: int,
                  batch_size: int,
-                 is_subseq: bool = False
+                 is_subseq: bool = False,
+                 bucket_batches: int = 0
                  ) -> None:
 
         self.maxlen = maxlen
         self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
 
         self.dataset_size = 0
         self.batch_counter = 0
         self.data_indices = []
 
-        self.prepared_data = []
         if not is_subseq:
-            for session in data:
-                self.prepared_data.append(session)
-                length = len(session)
-                if length > 2:
-                    for t in range(1, length - 1):
-                        self.prepared_data.append(session[:-t])
+            self.prepared_data = expand_sessions(data)
+        elif isinstance(data, SubseqData):
+            self.prepared_data = data
         else:
-            for session in data:
-                self.prepared_data.append(session)
+            self.prepared_data = SubseqData.from_sessions(data)
 
         self.data_indices = list(range(len(self.prepared_data)))
-        random.shuffle(self.data_indices)
+        self.shuffle()
+        self.seq, self.pos, self.lengths = None, None, None
+        self.weights = None
 
-    def label_generator(self,
-                        session: list,
-                        ) -> (list, int):
-        """ This method split sessions into input sequence and labels.
-        Args:
-            session (list): Original sub-sequence of different length.
-        Return:
-            seq (list): The input sequence with fixed length set by maxlen.
-            pos (int): Label (item number).
+    def shuffle(self) -> None:
+        """ This method shuffles data indices. With bucketing, shuffled indices are then sorted by length inside
+        pools of bucket_batches batches and the full batches of each pool are shuffled again, so that a batch holds
+        sub-sequences of similar length.
         """
-        seq = np.zeros([self.maxlen], dtype=np.int32)
-        pos = np.array(session[-1], dtype=np.int32)
-        idx = self.maxlen - 1
+        random.shuffle(self.data_indices)
+        if self.bucket_batches <= 0:
+            return
+        lengths = self.prepared_data.lengths()
+        pool_size = self.bucket_batches * self.batch_size
+        data_indices = []
+        for i in range(0, len(self.data_indices), pool_size):
+            pool = np.array(self.data_indices[i:i + pool_size], dtype=np.int64)
+            pool = pool[np.argsort(lengths[pool], kind='stable')]
+            # a last incomplete batch stays at the end, so that batches keep their boundaries
+            full_num = len(pool) // self.batch_size
+            batches = np.split(pool[:full_num * self.batch_size], full_num) if full_num else []
+            random.shuffle(batches)
+            data_indices.extend(np.concatenate(batches + [pool[full_num * self.batch_size:]]).tolist())
+        self.data_indices = data_indices
 
-        for itemId in reversed(session[:-1]):
-            seq[idx] = itemId
-            idx -= 1
-            if idx == -1:
-                break
+    def label_generator(self) -> (np.ndarray, np.ndarray):
+        """ This method splits all sub-sequences into input sequences and labels, once per split.
+        Returns:
+            seq (np.ndarray): Left-padded input sequences with fixed length set by maxlen, an (N, maxlen) int32 matrix.
+            pos (np.ndarray): Labels (item number), an (N,) int32 vector.
+        """
+        data = self.prepared_data
+        starts = data.offsets[data.sess_idx]
+        ends = data.ends
+        seq = np.zeros([len(ends), self.maxlen], dtype=np.int32)
+        # gather in blocks to bound the temporary index matrix
+        block = max(1, 2 ** 22 // self.maxlen)
+        for i in range(0, len(ends), block):
+            idx = ends[i:i + block, None] - 1 - self.maxlen + np.arange(self.maxlen)
+            seq[i:i + block] = np.where(idx >= starts[i:i + block, None], data.items[np.maximum(idx, 0)], 0)
+        pos = data.items[np.maximum(ends - 1, 0)] if len(data.items) else np.zeros(len(ends), dtype=np.int32)
 
         return seq, pos
 
+    def batch_indices(self) -> np.ndarray:
+        """ This method returns the indices of the next batch and moves to the next batch, sub-sequences
+        shorter than 2 have no label and are skipped.
+        Returns:
+            index (np.ndarray): Indices of sub-sequences in the batch.
+        """
+        if self.seq is None:
+            self.seq, self.pos = self.label_generator()
+            self.lengths = self.prepared_data.lengths()
+        start = self.batch_counter * self.batch_size
+        index = np.array(self.data_indices[start:start + self.batch_size], dtype=np.int64)
+        index = index[self.lengths[index] > 1]
+
+        self.batch_counter += 1
+        if self.batch_counter == self.batch_num():
+            self.batch_counter = 0
+            self.shuffle()
+
+        return index
+
     def add_exemplar(self,
-                     exemplar: list
+                     exemplar: 'ExemplarStore'
                      ) -> None:
         """ Add exemplar data and logits from previous cycle model
         Args:
-             exemplar (list): Exemplar data and corresponding logits.
+             exemplar (ExemplarStore): Exemplar data and corresponding logits.
         """
-        self.logits = []
-        for session, logits in exemplar:
-            self.prepared_data.append(session)
-            self.logits.append(logits)
+        self.exemplar_store = exemplar
+        self.exemplar_start = len(self.prepared_data)
+        self.prepared_data = SubseqData.concat([self.prepared_data, exemplar.sessions()])
+        if self.weights is not None:
+            self.weights = np.concatenate([self.weights, np.ones(len(exemplar), dtype=np.float32)])
 
         self.data_indices = list(range(len(self.prepared_data)))
-        random.shuffle(self.data_indices)
+        self.shuffle()
+        self.seq, self.pos, self.lengths = None, None, None
 
     def split_data(self,
                    valid_portion: float,
                    return_train: bool = False
-                   ) -> Union[list, tuple]:
+                   ) -> Union[SubseqData, tuple]:
         """ Split data into valid and train dataset and remove validation data from original training data.
         Args:
             valid_portion (float): The portion of validation dataset w.r.t entire dataset.
             return_train: If True, return validation data and train data, else only return validation data.
         Returns:
-            valid_data (list): Validation sub-sequence.
-            train_data (list): Training sub-sequence.
+            valid_data (SubseqData): Validation sub-sequence.
+            train_data (SubseqData): Training sub-sequence.
         """
 
         data_size = len(self.prepared_data)
@@ -201,64 +509,111 @@ class Sampler:
         np.random.shuffle(sidx)
 
         n_train = int(np.round(data_size * (1. - valid_portion)))
-        valid_data = [self.prepared_data[s] for s in sidx[n_train:]]
-        train_data = [self.prepared_data[s] for s in sidx[:n_train]]
+        valid_data = self.prepared_data.take(sidx[n_train:])
+        train_data = self.prepared_data.take(sidx[:n_train])
         self.prepared_data = train_data
+        if self.weights is not None:
+            self.weights = self.weights[sidx[:n_train]]
 
         self.data_indices = list(range(len(self.prepared_data)))
-        random.shuffle(self.data_indices)
+        self.shuffle()
+        self.seq, self.pos, self.lengths = None, None, None
 
         if return_train:
             return valid_data, train_data
         else:
             return valid_data
 
-    def sampler(self) -> list:
-        """ This method returns a batch of sample: N * (sequence, label).
+    def deduplicate(self) -> None:
+        """ This method collapses sub-sequences with identical input sequence and label into one sub-sequence,
+        weighted by its number of copies. Weights are scaled to mean 1, so that the weighted loss of a random batch
+        equals the loss over all sub-sequences in expectation, while an epoch has fewer batches.
+        """
+        seq, pos = self.label_generator()
+        if len(pos) == 0:
+            return
+        counts = self.weights if self.weights is not None else np.ones(len(pos), dtype=np.float32)
+        _, first, inverse = np.unique(np.column_stack((seq, pos)), axis=0, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(first))
+        # keep the first copy of each example, in original order
+        order = np.argsort(first)
+        keep = first[order]
+        counts = counts[order]
+        self.prepared_data = self.prepared_data.take(keep)
+        # sub-sequences shorter than 2 are skipped in batches and left out of the scale
+        valid = self.prepared_data.lengths() > 1
+        self.weights = (counts * (valid.sum() / max(counts[valid].sum(), 1))).astype(np.float32)
+
+        self.data_indices = list(range(len(self.prepared_data)))
+        self.shuffle()
+        self.seq, self.pos, self.lengths = seq[keep], pos[keep], self.prepared_data.lengths()
+
+    def batch_seq(self,
+                  index: np.ndarray
+                  ) -> np.ndarray:
+        """ This method gathers the input sequences of a batch, trimmed to the longest one when bucketing.
+        Args:
+            index (np.ndarray): Indices of sub-sequences in the batch.
         Returns:
-            one_batch (list): One batch of data in the size of N * (sequence length, 1).
-        """
-        one_batch = []
-        for i in range(self.batch_size):
-            if (i + self.batch_counter * self.batch_size) < len(self.prepared_data):
-                index = self.data_indices[i + self.batch_counter * self.batch_size]
-                session = self.prepared_data[index]
-                if len(session) <= 1:
-                    continue
-                one_batch.append(self.label_generator(session))
-            else:
-                break
+            seq (np.ndarray): Input sequences of the batch, N * sequence length.
+        """
+        seq = self.seq[index]
+        if self.bucket_batches > 0 and len(index):
+            seq = seq[:, self.maxlen - min(self.lengths[index].max() - 1, self.maxlen):]
+        return seq
 
-        self.batch_counter += 1
-        if self.batch_counter == self.batch_num():
-            self.batch_counter = 0
-            random.shuffle(self.data_indices)
+    def sampler(self) -> (np.ndarray, np.ndarray):
+        """ This method returns a batch of sample: N * (sequence, label).
+        Returns:
+            seq (np.ndarray): Input sequences of the batch, N * sequence length.
+            pos (np.ndarray): Labels of the batch, N.
+        """
+        index = self.batch_indices()
+        return self.batch_seq(index), self.pos[index]
 
-        return zip(*one_batch)
+    def weighted_sampler(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """ This method returns a batch of sample with loss weights: N * (sequence, label, weight).
+        Returns:
+            seq (np.ndarray): Input sequences of the batch, N * sequence length.
+            pos (np.ndarray): Labels of the batch, N.
+            weight (np.ndarray): Loss weights of the batch, N, all ones if duplicates are not collapsed.
+        """
+        index = self.batch_indices()
+        if self.weights is None:
+            weight = np.ones(len(index), dtype=np.float32)
+        else:
+            weight = self.weights[index]
+        return self.batch_seq(index), self.pos[index], weight
 
-    def exemplar_sampler(self) -> list:
+    def exemplar_sampler(self) -> (np.ndarray, np.ndarray, tuple):
         """ This method returns a batch of exemplar data: N * (exemplar, logits).
         Return:
-            one_batch (list): One batch of data in the size of N * (sequence length, previous item number).
-        """
-        one_batch = []
-        for i in range(self.batch_size):
-            if (i + self.batch_counter * self.batch_size) < len(self.prepared_data):
-                index = self.data_indices[i + self.batch_counter * self.batch_size]
-                session = self.prepared_data[index]
-                if len(session) <= 1:
-                    continue
-                seq, pos = self.label_generator(session)
-                one_batch.append((seq, pos, self.logits[index]))
-            else:
-                break
+            seq (np.ndarray): Input sequences of the batch, N * sequence length.
+            pos (np.ndarray): Labels of the batch, N.
+            targets (tuple): Logits of the batch, N * previous item number, or top-K logits with item indices and
+                tail probability, see ExemplarStore.targets.
+        """
+        index = self.batch_indices()
+        return self.batch_seq(index), self.pos[index], self.exemplar_store.targets(index - self.exemplar_start)
 
-        self.batch_counter += 1
-        if self.batch_counter == self.batch_num():
-            self.batch_counter = 0
-            random.shuffle(self.data_indices)
+    def exemplar_index_sampler(self) -> np.ndarray:
+        """ This method returns a batch of exemplars as their indices in the exemplar store, for exemplars kept
+        by the model.
+        Return:
+            index (np.ndarray): Indices of exemplars of the batch, N.
+        """
+        return (self.batch_indices() - self.exemplar_start).astype(np.int32)
 
-        return zip(*one_batch)
+    def exemplar_inputs(self) -> (np.ndarray, np.ndarray):
+        """ This method returns input sequences and labels of all exemplars, in the order of the exemplar store.
+        Return:
+            seq (np.ndarray): Left-padded input sequences, N * maxlen.
+            pos (np.ndarray): Labels, N.
+        """
+        if self.seq is None:
+            self.seq, self.pos = self.label_generator()
+            self.lengths = self.prepared_data.lengths()
+        return self.seq[self.exemplar_start:], self.pos[self.exemplar_start:]
 
     def data_size(self) -> int:
         """ Get the number of sub-sequences in the data set.
@@ -275,11 +630,108 @@ class Sampler:
         return math.ceil(len(self.prepared_data) * 1.0 / self.batch_size)
 
 
+def pad_left(seq: np.ndarray,
+             length: int
+             ) -> np.ndarray:
+    """ Left-pad input sequences with zeros to the given length.
+    Args:
+        seq (np.ndarray): Input sequences, N * sequence length.
+        length (int): Target sequence length, not shorter than the input.
+    Returns:
+        (np.ndarray): Input sequences, N * length.
+    """
+    if seq.shape[1] == length:
+        return seq
+    return np.pad(seq, ((0, 0), (length - seq.shape[1], 0)))
+
+
+class BatchPrefetcher:
+    """ This object prepares training batches, together with their exemplar batches, in a background thread and
+    keeps them in a bounded queue, so that training steps do not wait for batch construction. One epoch is prepared
+    at a time, so the samplers draw random numbers in the same order as without prefetching.
+    Args:
+        train_sampler (Sampler): Sampler of training data.
+        exemplar_sampler (Sampler): Sampler of exemplar data, None if exemplars are not used.
+        depth (int): Maximum number of prepared batches, 0 to prepare batches synchronously.
+        exemplar_index (bool): If True, exemplars are kept by the model and batches only hold their indices.
+    """
+
+    def __init__(self,
+                 train_sampler: 'Sampler',
+                 exemplar_sampler: Optional['Sampler'],
+                 depth: int,
+                 exemplar_index: bool = False
+                 ) -> None:
+
+        self.train_sampler = train_sampler
+        self.exemplar_sampler = exemplar_sampler
+        self.depth = depth
+        self.exemplar_index = exemplar_index
+
+    def batch(self) -> tuple:
+        """ This method prepares one ready-to-feed batch.
+        Returns:
+            seq (np.ndarray): Input sequences, training data followed by exemplars not kept by the model.
+            pos (np.ndarray): Labels of training data.
+            weight (np.ndarray): Loss weights of training data.
+            ex_pos (np.ndarray): Labels of exemplars, or indices of exemplars kept by the model, None without
+                exemplars.
+            targets (tuple): Distillation targets of exemplars, None without exemplars or with exemplar indices.
+        """
+        seq, pos, weight = self.train_sampler.weighted_sampler()
+        if self.exemplar_sampler is None:
+            return seq, pos, weight, None, None
+        if self.exemplar_index:
+            return seq, pos, weight, self.exemplar_sampler.exemplar_index_sampler(), None
+        ex_seq, ex_pos, targets = self.exemplar_sampler.exemplar_sampler()
+        length = max(seq.shape[1], ex_seq.shape[1])
+        return np.concatenate([pad_left(seq, length), pad_left(ex_seq, length)]), pos, weight, ex_pos, targets
+
+    def produce(self,
+                batch_num: int,
+                batches: queue.Queue
+                ) -> None:
+        """ This method puts batch_num batches into the queue, followed by None, or the raised exception.
+        """
+        try:
+            for _ in range(batch_num):
+                batches.put(self.batch())
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+
+    def epoch(self,
+              batch_num: int
+              ):
+        """ This method yields the batches of one epoch.
+        Args:
+            batch_num (int): Number of batches in the epoch.
+        """
+        if self.depth <= 0:
+            for _ in range(batch_num):
+                yield self.batch()
+            return
+
+        batches = queue.Queue(maxsize=self.depth)
+        producer = threading.Thread(target=self.produce, args=(batch_num, batches), daemon=True)
+        producer.start()
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+        producer.join()
+
+
 class Evaluator:
-    """ This object evaluates performance on valid or test data.
+    """ This object evaluates performance on valid or test data. Ranks of ground truth items are accumulated into a
+    histogram of ranks below the largest cutoff, so memory does not grow with the evaluated data.
     """
 
-    def __init__(self, data, is_subseq, maxlen, batch_size, max_item, mode, model, sess, logs):
+    def __init__(self, data, is_subseq, maxlen, batch_size, max_item, mode, model, sess, logs, cutoffs=(20, 10),
+                 score_batch=0):
         """
         :param args: args
         :param data: data to evaluate, valid data or test data
@@ -288,6 +740,9 @@ class Evaluator:
         :param mode: 'valid' or 'test'
         :param sess: tf session
         :param logs: logs
+        :param cutoffs: list of K of metrics @K, in display order
+        :param score_batch: number of sequences scored by one matmul with the item embeddings extracted once per
+                            evaluation, 0 to rank items in the graph for each batch
         """
         self.maxlen = maxlen
         self.batch_size = batch_size
@@ -296,10 +751,13 @@ class Evaluator:
         self.mode = mode
         self.model = model
         self.sess = sess
+        self.cutoffs = list(cutoffs)
+        self.score_batch = score_batch
 
         self.logs = logs
-        self.ranks = []
-        self.recall_20 = 0
+        self.rank_hist = np.zeros(max(self.cutoffs), dtype=np.int64)
+        self.count = 0
+        self.metrics = None
         self.desc = 'Validating epoch ' if mode == 'valid' else 'Testing epoch '
         self.evaluate_sampler = Sampler(data, maxlen, batch_size, is_subseq=is_subseq)
 
@@ -309,40 +767,272 @@ class Evaluator:
         :param exemplar: valid exemplar from previous period
         :param epoch: current epoch
         """
-        self.ranks = []
+        self.rank_hist[:] = 0
+        self.count = 0
+        items = np.arange(1, self.max_item + 1)
+        if self.score_batch:
+            # item embeddings are fixed during evaluation, only representations are computed for each batch
+            item_emb = self.model.item_embeddings(self.sess, self.max_item)
+        reps, targets, buffered = [], [], 0
         batch_num = self.evaluate_sampler.batch_num()
         for _ in tqdm(range(batch_num), total=batch_num, ncols=70, leave=False, unit='b',
                       desc=self.desc + str(epoch)):
             seq, pos = self.evaluate_sampler.sampler()
-            predictions = self.model.predict(self.sess, seq, list(range(1, self.max_item + 1)))
-            ground_truth = pos
-            rank = [pred[index - 1] for pred, index in zip(predictions, ground_truth)]
-            self.ranks.extend(rank)
+            if not self.score_batch:
+                # only the rank of the ground truth item is computed, instead of ranks of all items
+                self.accumulate(self.model.predict_rank(self.sess, seq, items, np.asarray(pos) - 1))
+                continue
+            reps.append(self.model.predict_rep(self.sess, seq))
+            targets.append(np.asarray(pos) - 1)
+            buffered += len(pos)
+            if buffered >= self.score_batch:
+                self.score(np.concatenate(reps), np.concatenate(targets), item_emb)
+                reps, targets, buffered = [], [], 0
+        if buffered:
+            self.score(np.concatenate(reps), np.concatenate(targets), item_emb)
+        self.metrics = self.compute_metrics()
         self.display(epoch)
 
+    def score(self, reps, targets, item_emb):
+        """
+        Score all items by representations of sequences and accumulate ranks of ground truth items, ties are ranked
+        by item order as in the graph
+        :param reps: representations of sequences, N * hidden units
+        :param targets: ground truth item indices (item - 1), N
+        :param item_emb: item embedding matrix, item number * hidden units
+        """
+        columns = np.arange(item_emb.shape[0])
+        for start in range(0, len(reps), self.score_batch):
+            logits = reps[start:start + self.score_batch] @ item_emb.T
+            target = targets[start:start + self.score_batch]
+            target_logits = logits[np.arange(len(target)), target][:, None]
+            rank = np.count_nonzero(logits > target_logits, axis=1) + \
+                np.count_nonzero((logits == target_logits) & (columns < target[:, None]), axis=1)
+            self.accumulate(rank)
+
+    def accumulate(self, rank):
+        """
+        Add ranks of ground truth items into the rank histogram
+        :param rank: ranks of ground truth items, starting from 0
+        """
+        self.rank_hist += np.bincount(rank[rank < len(self.rank_hist)], minlength=len(self.rank_hist))
+        self.count += len(rank)
+
+    def compute_metrics(self):
+        """
+        Compute MRR@K, RECALL@K and NDCG@K from the rank histogram. With one ground truth item, RECALL@K is
+        also the hit rate.
+        :return: dictionary from metric name to value, ordered by cutoffs
+        """
+        count = max(self.count, 1)
+        ranks = np.arange(len(self.rank_hist))
+        metrics = {}
+        for k in self.cutoffs:
+            hist = self.rank_hist[:k]
+            metrics['MRR@%d' % k] = float(np.sum(hist / (ranks[:k] + 1.0))) / count
+            metrics['RECALL@%d' % k] = float(np.sum(hist)) / count
+            metrics['NDCG@%d' % k] = float(np.sum(hist / np.log2(ranks[:k] + 2.0))) / count
+        return metrics
+
     def results(self):
-        """ This method returns evaluation results (MRR@20, RECALL@20, MRR@10, RECALL@10)
+        """ This method returns evaluation results of the last evaluation, e.g. {'MRR@20': ..., 'RECALL@20': ...,
+        'NDCG@20': ...}
         """
-        valid_user = len(self.ranks)
-        valid_ranks_20 = list(filter(lambda x: x < 20, self.ranks))
-        valid_ranks_10 = list(filter(lambda x: x < 10, self.ranks))
-        RECALL_20 = len(valid_ranks_20)
-        MRR_20 = sum(map(lambda x: 1.0 / (x + 1), valid_ranks_20))
-        RECALL_10 = len(valid_ranks_10)
-        MRR_10 = sum(map(lambda x: 1.0 / (x + 1), valid_ranks_10))
-        return MRR_20 / valid_user, RECALL_20 / valid_user, MRR_10 / valid_user, RECALL_10 / valid_user
+        return self.metrics
 
     def display(self, epoch):
         """
-        This method display and save evaluation metrics(MRR@20, RECALL@20, MRR@10, RECALL@10)
+        This method display and save evaluation metrics (MRR@K, RECALL@K, NDCG@K)
         """
-        results = self.results()
-        info = 'epoch:%d, %s (MRR@20: %.4f, RECALL@20: %.4f, MRR@10: %.4f, RECALL@10: %.4f)' \
-               % (epoch, self.mode, results[0], results[1], results[2], results[3])
+        info = 'epoch:%d, %s (%s)' % (epoch, self.mode,
+                                      ', '.join('%s: %.4f' % (name, value) for name, value in self.metrics.items()))
         print(info)
         self.logs.write(info + '\n')
 
 
+class ExemplarStore:
+    """ This object keeps exemplars of a period in contiguous arrays: a left-padded int32 matrix of exemplar
+    sessions and a logits matrix in float32, float16 or row-wise int8 quantization, which can be memory-mapped.
+    With top-K targets, only the K largest logits of each exemplar are kept with their item indices and the
+    probability mass of the other items.
+    Args:
+        seq (np.ndarray): Exemplar sessions (input sequence followed by label), N * session length, left-padded.
+        logits (np.ndarray): Logits of exemplars from the model of their period, N * item number, or N * K.
+        scale (np.ndarray): Row-wise scale of int8 logits, None for float logits.
+        offset (np.ndarray): Row-wise offset of int8 logits, None for float logits.
+        indices (np.ndarray): Item indices (item number - 1) of top-K logits, N * K, None for full logits.
+        tail (np.ndarray): Probability of items outside top-K, N, None for full logits.
+    """
+
+    dtypes = ('float32', 'float16', 'int8')
+
+    def __init__(self,
+                 seq: np.ndarray,
+                 logits: np.ndarray,
+                 scale: Optional[np.ndarray] = None,
+                 offset: Optional[np.ndarray] = None,
+                 indices: Optional[np.ndarray] = None,
+                 tail: Optional[np.ndarray] = None
+                 ) -> None:
+
+        self.seq = seq
+        self.logits = logits
+        self.scale = scale
+        self.offset = offset
+        self.indices = indices
+        self.tail = tail
+
+    @classmethod
+    def from_arrays(cls,
+                    seq: np.ndarray,
+                    logits: np.ndarray,
+                    dtype: str = 'float16',
+                    topk: int = 0
+                    ) -> 'ExemplarStore':
+        """ Build an exemplar store, logits are converted to the given type.
+        Args:
+            seq (np.ndarray): Exemplar sessions, N * session length, left-padded.
+            logits (np.ndarray): Logits of exemplars, N * item number.
+            dtype (str): Storage type of logits, 'float32', 'float16' or 'int8'.
+            topk (int): If positive, only keep the topk largest logits of each exemplar.
+        Returns:
+            (ExemplarStore): Exemplar store.
+        """
+        if dtype not in cls.dtypes:
+            raise ValueError('Invalid exemplar logits type %s' % dtype)
+        seq = np.ascontiguousarray(seq, dtype=np.int32)
+        logits = np.asarray(logits, dtype=np.float32)
+        indices, tail = None, None
+        if topk > 0:
+            k = min(topk, logits.shape[1])
+            indices = np.argpartition(-logits, k - 1, axis=1)[:, :k] if k else np.zeros((len(logits), 0), np.int64)
+            top = np.take_along_axis(logits, indices, axis=1)
+            order = np.argsort(-top, axis=1, kind='stable')
+            indices = np.take_along_axis(indices, order, axis=1).astype(np.int32)
+            top = np.take_along_axis(top, order, axis=1)
+            # probability mass of the other items under the full softmax
+            row_max = logits.max(axis=1, keepdims=True) if logits.size else np.zeros((len(logits), 1), np.float32)
+            top_mass = np.exp(top - row_max).sum(axis=1) / np.exp(logits - row_max).sum(axis=1)
+            tail = np.clip(1.0 - top_mass, 0.0, 1.0).astype(np.float32)
+            logits = top
+        if dtype != 'int8':
+            return cls(seq, logits.astype(dtype), indices=indices, tail=tail)
+        quantized, scale, offset = ExemplarStore.quantize(logits)
+        return cls(seq, quantized, scale, offset, indices, tail)
+
+    @staticmethod
+    def quantize(logits: np.ndarray) -> tuple:
+        """ Quantize logits to int8 row by row, the range of each row is mapped onto [-127, 127].
+        Args:
+            logits (np.ndarray): Float logits, N * width.
+        Returns:
+            quantized (np.ndarray): Int8 logits, N * width.
+            scale (np.ndarray): Row-wise scale, N.
+            offset (np.ndarray): Row-wise offset, N.
+        """
+        low = logits.min(axis=1) if logits.size else np.zeros(len(logits), dtype=np.float32)
+        high = logits.max(axis=1) if logits.size else np.zeros(len(logits), dtype=np.float32)
+        offset = ((high + low) / 2).astype(np.float32)
+        scale = np.maximum((high - low) / 254, np.finfo(np.float32).tiny).astype(np.float32)
+        quantized = np.rint((logits - offset[:, None]) / scale[:, None]).astype(np.int8)
+        return quantized, scale, offset
+
+    @staticmethod
+    def concat(stores: list) -> 'ExemplarStore':
+        """ Join exemplar stores with the same type of logits, e.g. the exemplars of each item.
+        Args:
+            stores (list): Non-empty list of exemplar stores.
+        Returns:
+            (ExemplarStore): Exemplars of all stores in order.
+        """
+        length = max(store.seq.shape[1] for store in stores)
+        seq = np.concatenate([pad_left(store.seq, length) for store in stores])
+        arrays = [np.concatenate([getattr(store, name) for store in stores])
+                  if getattr(stores[0], name) is not None else None
+                  for name in ('logits', 'scale', 'offset', 'indices', 'tail')]
+        return ExemplarStore(seq, *arrays)
+
+    def save(self,
+             path: str
+             ) -> None:
+        """ Save arrays of the store into .npy files with the given path prefix.
+        Args:
+            path (str): Path prefix of the files.
+        """
+        np.save(path + '.seq.npy', self.seq)
+        np.save(path + '.logits.npy', self.logits)
+        if self.scale is not None:
+            np.save(path + '.scale.npy', self.scale)
+            np.save(path + '.offset.npy', self.offset)
+        if self.indices is not None:
+            np.save(path + '.indices.npy', self.indices)
+            np.save(path + '.tail.npy', self.tail)
+
+    @classmethod
+    def load(cls,
+             path: str,
+             mmap: bool = True
+             ) -> 'ExemplarStore':
+        """ Load a store saved by save, the logits matrix is memory-mapped if mmap is True.
+        Args:
+            path (str): Path prefix of the files.
+            mmap (bool): If True, logits stay on disk and rows are read when sampled.
+        Returns:
+            (ExemplarStore): Exemplar store.
+        """
+        seq = np.load(path + '.seq.npy')
+        logits = np.load(path + '.logits.npy', mmap_mode='r' if mmap else None)
+        scale, offset, indices, tail = None, None, None, None
+        if os.path.exists(path + '.scale.npy'):
+            scale, offset = np.load(path + '.scale.npy'), np.load(path + '.offset.npy')
+        if os.path.exists(path + '.indices.npy'):
+            indices = np.load(path + '.indices.npy', mmap_mode='r' if mmap else None)
+            tail = np.load(path + '.tail.npy')
+        return cls(seq, logits, scale, offset, indices, tail)
+
+    def sessions(self) -> SubseqData:
+        """ Exemplar sessions without padding.
+        Returns:
+            (SubseqData): One sub-sequence per exemplar.
+        """
+        nonzero = self.seq != 0
+        offsets = np.zeros(len(self.seq) + 1, dtype=np.int64)
+        np.cumsum(nonzero.sum(axis=1), out=offsets[1:])
+        return SubseqData(self.seq[nonzero], offsets, np.arange(len(self.seq)), offsets[1:].copy())
+
+    def logits_rows(self,
+                    index: np.ndarray
+                    ) -> np.ndarray:
+        """ Gather logits of the given exemplars as float32.
+        Args:
+            index (np.ndarray): Indices of exemplars.
+        Returns:
+            (np.ndarray): Logits, N * item number, or N * K with top-K targets.
+        """
+        logits = self.logits[index].astype(np.float32)
+        if self.scale is not None:
+            logits = logits * self.scale[index, None] + self.offset[index, None]
+        return logits
+
+    def targets(self,
+                index: np.ndarray
+                ) -> tuple:
+        """ Gather distillation targets of the given exemplars.
+        Args:
+            index (np.ndarray): Indices of exemplars.
+        Returns:
+            logits (np.ndarray): Logits, N * item number, or N * K with top-K targets.
+            indices (np.ndarray): Item indices of top-K logits, N * K, None for full logits.
+            tail (np.ndarray): Probability of items outside top-K, N, None for full logits.
+        """
+        if self.indices is None:
+            return self.logits_rows(index), None, None
+        return self.logits_rows(index), np.asarray(self.indices[index]), self.tail[index]
+
+    def __len__(self) -> int:
+        return len(self.seq)
+
+
 class ExemplarGenerator:
     """ This object select exemplars from given data.
     Args:
@@ -351,14 +1041,22 @@ class ExemplarGenerator:
 
     """
 
-    def __init__(self, data, exemplar_size, disable_m, batch_size, maxlen, dropout_rate, max_item, logs):
+    def __init__(self, data, exemplar_size, disable_m, batch_size, maxlen, dropout_rate, max_item, logs, topk=0,
+                 dtype='float16', keep_logits=True):
         """
         :param m: number of exemplars per item
         :param data: train data, valid data at current cycle and exemplar data from previous cycle
         :param max_item: accumulative number of item
         :param logs: logs
+        :param topk: if positive, only keep the topk largest logits of each exemplar
+        :param dtype: storage type of logits, 'float32', 'float16' or 'int8'
+        :param keep_logits: if False, logits are neither computed nor kept, only exemplar sessions, e.g. when a
+                            teacher model recomputes logits
         """
         self.exemplars = dict()
+        self.topk = topk
+        self.dtype = dtype
+        self.keep_logits = keep_logits
         self.m = exemplar_size
         self.data = data
         self.max_item = max_item
@@ -379,18 +1077,32 @@ class ExemplarGenerator:
                 self.sess_by_item[item].append(session)
                 self.item_count[item - 1] += 1
 
-        self.exemplars = defaultdict(list)
+        self.exemplars = dict()
         if disable_m:
             self.item_count = np.ones_like(self.item_count)
         item_prob = self.item_count / self.item_count.sum()
         item_count = np.random.multinomial(n=self.m, pvals=item_prob, size=1)[0]
         self.item_count = np.int32(item_count)
 
+    def save_exemplars(self, item, seq, logits):
+        """
+        Keep selected exemplars of an item in the storage type of logits, top-K logits are taken right away, so full
+        float32 logits are only kept for the item being selected
+        :param item: label
+        :param seq: selected sessions
+        :param logits: logits of selected sessions, None if logits are not kept
+        """
+        if not self.keep_logits:
+            self.exemplars[item] = ExemplarStore(np.ascontiguousarray(seq, dtype=np.int32),
+                                                 np.zeros((len(seq), 0), dtype=np.float32))
+            return
+        self.exemplars[item] = ExemplarStore.from_arrays(seq, logits, self.dtype, self.topk)
+
     def herding(self, rep, logits, item, seq, m):
         """
         Herding algorithm for exemplar selection
         :param rep: representations
-        :param logits: logits
+        :param logits: logits, None if logits are not kept
         :param item: label
         :param seq: input session (item sequence)
         :param m: number of exemplar per label
@@ -410,7 +1122,7 @@ class ExemplarGenerator:
             if ind_max not in selected_ids:
                 selected_ids.append(ind_max)
                 counter += 1
-        self.exemplars[item] = [[seq[i][seq[i] != 0].tolist(), logits[i].tolist()] for i in selected_ids]
+        self.save_exemplars(item, seq[selected_ids], logits[selected_ids] if logits is not None else None)
         return counter
 
     def herding_selection(self, sess, model):
@@ -424,12 +1136,13 @@ class ExemplarGenerator:
             seq = self.sess_by_item[item]
             seq = np.array(seq)
             input_seq = seq[:, :-1]
-            rep, logits = sess.run([model.rep, model.logits], {model.input_seq: input_seq,
-                                                               model.dropout_rate: self.dropout_rate,
-                                                               model.max_item: self.max_item,
-                                                               model.is_training: False})
-            rep = np.array(rep)
-            logits = np.array(logits)
+            fetches = [model.rep, model.logits] if self.keep_logits else [model.rep]
+            outputs = sess.run(fetches, {model.input_seq: input_seq,
+                                         model.dropout_rate: self.dropout_rate,
+                                         model.max_item: self.max_item,
+                                         model.is_training: False})
+            rep = np.array(outputs[0])
+            logits = np.array(outputs[1]) if self.keep_logits else None
             saved = self.herding(rep, logits, item, seq, min(m, len(seq)))
             saved_num += saved
         print('Total saved exemplar: %d' % saved_num)
@@ -448,15 +1161,16 @@ class ExemplarGenerator:
             seq = self.sess_by_item[item]
             seq_num = len(seq)
             seq = np.array(seq)
-            loss, logits = sess.run([model.loss, model.logits], {model.input_seq: seq[:, :-1],
-                                                                 model.pos: seq[:, -1],
-                                                                 model.dropout_rate: self.dropout_rate,
-                                                                 model.max_item: self.max_item,
-                                                                 model.is_training: False})
-            loss = np.array(loss)
-            logits = np.array(logits)
+            fetches = [model.loss, model.logits] if self.keep_logits else [model.loss]
+            outputs = sess.run(fetches, {model.input_seq: seq[:, :-1],
+                                         model.pos: seq[:, -1],
+                                         model.dropout_rate: self.dropout_rate,
+                                         model.max_item: self.max_item,
+                                         model.is_training: False})
+            loss = np.array(outputs[0])
             selected_ids = loss.argsort()[:int(min(m, seq_num))]
-            self.exemplars[item] = [[seq[i][seq[i] != 0].tolist(), logits[i].tolist()] for i in selected_ids]
+            logits = np.array(outputs[1])[selected_ids] if self.keep_logits else None
+            self.save_exemplars(item, seq[selected_ids], logits)
             saved_num += len(selected_ids)
         print('Total saved exemplar: %d' % saved_num)
         self.logs.write('Total saved exemplar: %d\n' % saved_num)
@@ -474,13 +1188,25 @@ class ExemplarGenerator:
             if m > 0:
                 selected_ids = np.random.choice(seq_num, min(m, seq_num), replace=False)
                 selected_seq = seq[selected_ids]
-                logits = sess.run(model.logits, {model.input_seq: selected_seq[:, :-1],
-                                                 model.dropout_rate: self.dropout_rate,
-                                                 model.max_item: self.max_item,
-                                                 model.is_training: False})
-                logits = np.array(logits)
-                for s, l in zip(selected_seq, logits):
-                    self.exemplars[item].append([s[s != 0].tolist(), l.tolist()])
-                    saved_num += 1
+                logits = None
+                if self.keep_logits:
+                    logits = sess.run(model.logits, {model.input_seq: selected_seq[:, :-1],
+                                                     model.dropout_rate: self.dropout_rate,
+                                                     model.max_item: self.max_item,
+                                                     model.is_training: False})
+                    logits = np.array(logits)
+                self.save_exemplars(item, selected_seq, logits)
+                saved_num += len(selected_seq)
         print('Total saved exemplar: %d' % saved_num)
         self.logs.write('Total saved exemplar: %d\n' % saved_num)
+
+    def to_store(self):
+        """
+        This method collects selected exemplars of all items into an exemplar store
+        :return: exemplar store
+        """
+        stores = [store for store in self.exemplars.values() if len(store)]
+        if not stores:
+            return ExemplarStore.from_arrays(np.zeros((0, 0), dtype=np.int32), np.zeros((0, 0)), self.dtype,
+                                             self.topk if self.keep_logits else 0)
+        return ExemplarStore.concat(stores)